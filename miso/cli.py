@@ -2,13 +2,24 @@ import os.path
 from pathlib import Path
 
 import click
+from PIL import Image
 
+from miso.object_detection.dataset.annotation import RectangleAnnotation
 from miso.object_detection.dataset.cvat.cvat_web_api import CvatTask
+from miso.object_detection.dataset.dataset import ObjectDetectionDataset
+from miso.object_detection.dataset.pack import pack_project as pack_project_fn
 from miso.object_detection.dataset.project import Project
-from miso.object_detection.inference import infer
+from miso.object_detection.distill import distill as distill_fn
+from miso.object_detection.inference import infer, compare_models as compare_models_fn, load_model_labels, \
+    optimize_model, OPTIMIZED_MODEL_FILENAME
+from miso.object_detection.loader import LOADER_CONFIG_ENV, benchmark_loader, loader_config_path, save_loader_config
 from miso.object_detection.inference import infer_directory as infer_directory_fn
-from miso.object_detection.training import train
-from miso.object_detection.crop import crop_objects as crop_objects_fn
+from miso.object_detection.models import MODEL_ARCHITECTURES
+from miso.object_detection.sweep import expand_sweep_spec, load_sweep_spec, sweep as sweep_fn
+from miso.object_detection.training import train, prepare_project
+from miso.object_detection.crop import crop_objects as crop_objects_fn, benchmark_crop_formats, CROP_FORMATS
+from miso.object_detection.transforms import get_transforms
+from miso.shared.decode import select_fastest_decoders
 from miso.shared.utils import now_as_str
 
 
@@ -17,6 +28,32 @@ def cli():
     pass
 
 
+def load_tasks(tasks: str, wsl2: bool, api: str):
+    # Create project from a comma separated list of task ids
+    tasks = [int(task.strip()) for task in tasks.split(",")]
+    project = Project()
+    for task in tasks:
+        task = CvatTask("http://cvat:8080",
+                        task,
+                        is_wsl2=wsl2,
+                        api=api,
+                        debug=True)
+        task.load()
+        project.add_project(task.project)
+    return project
+
+
+def merge_labels(project: Project, labels, merge_label):
+    # Merge the labels into a single label, returns the new list of labels
+    if merge_label is None:
+        return labels
+    for label in project.label_dict.values():
+        if label.name in labels:
+            project.rename_label(label.name, merge_label)
+    project.update_label_dict()
+    return [merge_label]
+
+
 @cli.command()
 @click.option('-t',
               '--tasks',
@@ -78,6 +115,141 @@ def cli():
               default="sgd",
               show_default=True,
               help='Optimiser to use')
+@click.option('--cache-gb',
+              type=float,
+              default=0,
+              show_default=True,
+              help='Size of the shared memory image cache in GB (0 to disable)')
+@click.option('--cache-mode',
+              type=click.Choice(["decoded", "encoded"]),
+              default="decoded",
+              show_default=True,
+              help='Cache decoded images (fastest) or the compressed image files (smallest)')
+@click.option('--pack-dir',
+              type=str,
+              default=None,
+              help='Train from a pack of decoded images in this directory (created or updated if needed)')
+@click.option('--aspect-ratio-group-factor',
+              type=int,
+              default=3,
+              show_default=True,
+              help='Batch images with similar aspect ratios using 2k+1 aspect ratio bins (-1 to disable)')
+@click.option("--full-decode",
+              is_flag=True,
+              default=False,
+              help="Always decode JPEGs at full resolution, even if the model will downsample them")
+@click.option("--patch-size",
+              type=int,
+              default=None,
+              help="Train at native resolution on windows of this size centred on the objects, plus random background "
+                   "windows. Use for very large images. Inference is then done on overlapping tiles of this size")
+@click.option("--sampler",
+              type=click.Choice(["uniform", "repeat-factor"]),
+              default="uniform",
+              show_default=True,
+              help="How training images are sampled. repeat-factor repeats images with rare labels (LVIS repeat "
+                   "factor sampling)")
+@click.option("--repeat-threshold",
+              type=float,
+              default=0.1,
+              show_default=True,
+              help="Repeat factor sampling: images with labels found in less than this fraction of the images "
+                   "are repeated")
+@click.option("--epoch-length",
+              type=int,
+              default=None,
+              help="Number of images (or patches) per epoch, default is the size of the training set")
+@click.option("--precision",
+              type=click.Choice(["fp32", "amp", "bf16"]),
+              default="fp32",
+              show_default=True,
+              help="Training precision. amp uses float16 with loss scaling on GPU (bfloat16 on CPU), bf16 uses "
+                   "bfloat16 (GPU with bfloat16 support, or CPU)")
+@click.option("--checkpoint-epochs",
+              type=int,
+              default=1,
+              show_default=True,
+              help="Save a checkpoint to the model directory every this many epochs (0 to disable)")
+@click.option("--checkpoint-minutes",
+              type=float,
+              default=None,
+              help="Also save a checkpoint when this many minutes have passed since the last one")
+@click.option("--resume",
+              is_flag=True,
+              default=False,
+              help="Continue training from the checkpoint in the model directory")
+@click.option("--eval-every",
+              type=int,
+              default=1,
+              show_default=True,
+              help="Evaluate on the whole test set every this many epochs (0 for only at the end)")
+@click.option("--eval-subset",
+              type=int,
+              default=None,
+              help="Evaluate on a fixed subset of this many test images, with every label, on the other epochs")
+@click.option("--nproc",
+              type=int,
+              default=1,
+              show_default=True,
+              help="Number of training processes. On a GPU machine, one process per GPU (nccl), on a CPU machine the "
+                   "cores are shared between the processes (gloo). The batch size is per process")
+@click.option("--accumulate-steps",
+              type=int,
+              default=1,
+              show_default=True,
+              help="Number of batches to accumulate the gradients of before each optimizer step")
+@click.option("--memory-budget-gb",
+              type=float,
+              default=None,
+              help="Find the largest batch size that fits in this much GPU memory (replaces --batch-size)")
+@click.option("--target-batch-size",
+              type=int,
+              default=None,
+              help="Effective batch size to reach with gradient accumulation (replaces --accumulate-steps)")
+@click.option("--patience",
+              type=int,
+              default=None,
+              help="Stop training when the validation metric has not improved for this many full evaluations, and "
+                   "keep the weights of the best evaluation")
+@click.option("--early-stopping-metric",
+              type=click.Choice(["ap", "ap50", "ap75"]),
+              default="ap50",
+              show_default=True,
+              help="Validation metric used with --patience")
+@click.option("--trainable-backbone-layers",
+              type=click.IntRange(0, 6),
+              default=None,
+              help="Number of backbone layers to train, from the last (0 freezes the backbone, 5 trains all of a "
+                   "ResNet, 6 all of a MobileNet). Default is that of the architecture: 3, or 6 for ssdlite")
+@click.option("--freeze-epochs",
+              type=int,
+              default=0,
+              show_default=True,
+              help="Train with the backbone frozen for this many epochs first, then with --trainable-backbone-layers")
+@click.option("--arch",
+              type=click.Choice(list(MODEL_ARCHITECTURES.keys())),
+              default="fasterrcnn_resnet50",
+              show_default=True,
+              help="Model architecture, the mobilenet models are faster on CPU")
+@click.option("--min-size",
+              type=int,
+              default=None,
+              help="Minimum size of the shorter side of the images given to the model (default of the architecture, "
+                   "fixed for ssdlite)")
+@click.option("--max-size",
+              type=int,
+              default=None,
+              help="Maximum size of the longer side of the images given to the model (default of the architecture, "
+                   "fixed for ssdlite)")
+@click.option("--telemetry",
+              is_flag=True,
+              default=False,
+              help="Log the times, losses and memory of each iteration to telemetry.jsonl in the model directory")
+@click.option("--compile",
+              "compile_model",
+              is_flag=True,
+              default=False,
+              help="Compile the backbone with torch.compile (falls back to eager mode if it fails or is not faster)")
 def train_object_detector(tasks: str,
                           labels: str,
                           merge_label: str,
@@ -89,30 +261,44 @@ def train_object_detector(tasks: str,
                           data: str,
                           max_epochs,
                           alrs_epochs,
-                          optimiser):
+                          optimiser,
+                          cache_gb,
+                          cache_mode,
+                          pack_dir,
+                          aspect_ratio_group_factor,
+                          full_decode,
+                          patch_size,
+                          sampler,
+                          repeat_threshold,
+                          epoch_length,
+                          precision,
+                          checkpoint_epochs,
+                          checkpoint_minutes,
+                          resume,
+                          eval_every,
+                          eval_subset,
+                          nproc,
+                          accumulate_steps,
+                          memory_budget_gb,
+                          target_batch_size,
+                          patience,
+                          early_stopping_metric,
+                          trainable_backbone_layers,
+                          freeze_epochs,
+                          arch,
+                          min_size,
+                          max_size,
+                          telemetry,
+                          compile_model):
     # Tasks and labels
-    tasks = [int(task.strip()) for task in tasks.split(",")]
     if labels is not None:
         labels = [label.strip() for label in labels.split(",")]
 
     # Create project from tasks
-    project = Project()
-    for task in tasks:
-        task = CvatTask("http://cvat:8080",
-                        task,
-                        is_wsl2=wsl2,
-                        api=api,
-                        debug=True)
-        task.load()
-        project.add_project(task.project)
+    project = load_tasks(tasks, wsl2, api)
 
     # Merge labels if desired
-    if merge_label is not None:
-        for label in project.label_dict.values():
-            if label.name in labels:
-                project.rename_label(label.name, merge_label)
-        project.update_label_dict()
-        labels = [merge_label]
+    labels = merge_labels(project, labels, merge_label)
 
     # Train model
     # TODO train test split
@@ -123,7 +309,233 @@ def train_object_detector(tasks: str,
           batch_size=batch_size,
           max_epochs=max_epochs,
           alrs_epochs=alrs_epochs,
-          optimiser=optimiser)
+          optimiser=optimiser,
+          cache_gb=cache_gb,
+          cache_mode=cache_mode,
+          pack_dir=pack_dir,
+          aspect_ratio_group_factor=aspect_ratio_group_factor,
+          reduced_decode=not full_decode,
+          patch_size=patch_size,
+          sampler=sampler,
+          repeat_threshold=repeat_threshold,
+          epoch_length=epoch_length,
+          precision=precision,
+          checkpoint_epochs=checkpoint_epochs,
+          checkpoint_minutes=checkpoint_minutes,
+          resume=resume,
+          eval_every=eval_every,
+          eval_subset=eval_subset,
+          nproc=nproc,
+          accumulate_steps=accumulate_steps,
+          memory_budget_gb=memory_budget_gb,
+          target_batch_size=target_batch_size,
+          patience=patience,
+          early_stopping_metric=early_stopping_metric,
+          trainable_backbone_layers=trainable_backbone_layers,
+          freeze_epochs=freeze_epochs,
+          arch=arch,
+          min_size=min_size,
+          max_size=max_size,
+          telemetry=telemetry,
+          compile_model=compile_model)
+
+
+@cli.command()
+@click.option('-t',
+              '--tasks',
+              type=str,
+              prompt='List of task ids to train on',
+              help='List of task ids to train on separated by commas')
+@click.option('-l',
+              '--labels',
+              type=str,
+              default=None,
+              help='List of label names to train on separated by commas')
+@click.option('--merge-label',
+              type=str,
+              default=None,
+              help='Merge the labels into a single label')
+@click.option('-s',
+              '--spec',
+              type=str,
+              prompt='Sweep spec JSON file',
+              help='Sweep spec JSON file, with the train parameters to sweep (see README)')
+@click.option('-o',
+              '--output-dir',
+              type=str,
+              default="/obj_det/sweeps",
+              show_default=True,
+              help='Sweep output directory')
+@click.option('-n',
+              '--name',
+              type=str,
+              default=None,
+              help='Sweep name')
+@click.option('--cores-per-run',
+              type=int,
+              default=2,
+              show_default=True,
+              help='Number of cores for each run')
+@click.option('--max-parallel',
+              type=int,
+              default=None,
+              help='Maximum number of runs at a time (default is as many as there are cores for)')
+@click.option('--memory-budget-gb',
+              type=float,
+              default=None,
+              help='GPU memory in GB shared by the runs at a time')
+@click.option('--cache-gb',
+              type=float,
+              default=0,
+              show_default=True,
+              help='Size of the shared memory image cache in GB used by all the runs (0 to disable)')
+@click.option('--cache-mode',
+              type=click.Choice(["decoded", "encoded"]),
+              default="decoded",
+              show_default=True,
+              help='Cache decoded images (fastest) or the compressed image files (smallest)')
+@click.option("--wsl2",
+              is_flag=True,
+              default=False,
+              help="Running this on a windows machine using WSL2 instead of docker")
+@click.option('--api',
+              type=str,
+              default="v1",
+              show_default=True,
+              help='CVAT api version string, v1 or v2')
+def sweep(tasks, labels, merge_label, spec, output_dir, name, cores_per_run, max_parallel, memory_budget_gb,
+          cache_gb, cache_mode, wsl2, api):
+    if labels is not None:
+        labels = [label.strip() for label in labels.split(",")]
+    runs = expand_sweep_spec(load_sweep_spec(spec))
+    project = load_tasks(tasks, wsl2, api)
+    labels = merge_labels(project, labels, merge_label)
+    sweep_fn(project,
+             labels,
+             runs,
+             output_dir=output_dir,
+             name=name,
+             cores_per_run=cores_per_run,
+             max_parallel=max_parallel,
+             memory_budget_gb=memory_budget_gb,
+             cache_gb=cache_gb,
+             cache_mode=cache_mode)
+
+
+@cli.command()
+@click.option('-t',
+              '--tasks',
+              type=str,
+              prompt='List of task ids to train on',
+              help='List of task ids to train on separated by commas, unannotated images are labelled by the teacher')
+@click.option('-i',
+              '--input-dir',
+              type=str,
+              default=None,
+              help='Directory of more unlabelled images to be labelled by the teacher')
+@click.option('--model-dir',
+              type=str,
+              default="/obj_det/models",
+              show_default=True,
+              help='Directory containing models')
+@click.option('--teacher',
+              type=str,
+              prompt='Name of folder containing the teacher model',
+              help='Name of folder containing the teacher model')
+@click.option('-m',
+              '--model',
+              type=str,
+              default=None,
+              help='Student model name')
+@click.option("--arch",
+              type=click.Choice(list(MODEL_ARCHITECTURES.keys())),
+              default="fasterrcnn_mobilenet_v3_large_fpn",
+              show_default=True,
+              help="Student model architecture")
+@click.option('--threshold', type=float, default=0.5,
+              show_default=True,
+              help='Score threshold of the teacher detections used for training')
+@click.option('--holdout', type=float, default=0.2,
+              show_default=True,
+              help='Fraction of the annotated images held out to compare the teacher and student')
+@click.option('--batch-size',
+              type=int,
+              default=2,
+              show_default=True,
+              help='Batch size for training (reduce if getting out-of-memory errors')
+@click.option('--max-epochs',
+              type=int,
+              default="100000",
+              show_default=True,
+              help='Maximum number of epochs')
+@click.option('--cache-gb',
+              type=float,
+              default=0,
+              show_default=True,
+              help='Size of the shared memory image cache in GB (0 to disable)')
+@click.option("--wsl2",
+              is_flag=True,
+              default=False,
+              help="Running this on a windows machine using WSL2 instead of docker")
+@click.option('--api',
+              type=str,
+              default="v1",
+              show_default=True,
+              help='CVAT api version string, v1 or v2')
+def distill(tasks, input_dir, model_dir, teacher, model, arch, threshold, holdout, batch_size, max_epochs, cache_gb,
+            wsl2, api):
+    project = load_tasks(tasks, wsl2, api)
+    unlabelled_project = Project.from_directory(input_dir) if input_dir is not None else None
+    distill_fn(project,
+               os.path.join(model_dir, teacher),
+               output_dir=model_dir,
+               name=model,
+               arch=arch,
+               threshold=threshold,
+               holdout_fraction=holdout,
+               unlabelled_project=unlabelled_project,
+               batch_size=batch_size,
+               max_epochs=max_epochs,
+               cache_gb=cache_gb)
+
+
+@cli.command()
+@click.option('-t',
+              '--tasks',
+              type=str,
+              prompt='List of task ids to pack',
+              help='List of task ids to pack separated by commas')
+@click.option('-l',
+              '--labels',
+              type=str,
+              default=None,
+              help='List of label names to train on separated by commas')
+@click.option('--merge-label',
+              type=str,
+              default=None,
+              help='Merge the labels into a single label')
+@click.option('-o',
+              '--output-dir',
+              type=str,
+              prompt='Directory to store the pack',
+              help='Directory to store the pack')
+@click.option("--wsl2",
+              is_flag=True,
+              default=False,
+              help="Running this on a windows machine using WSL2 instead of docker")
+@click.option('--api',
+              type=str,
+              default="v1",
+              show_default=True,
+              help='CVAT api version string, v1 or v2')
+def pack_project(tasks, labels, merge_label, output_dir, wsl2, api):
+    if labels is not None:
+        labels = [label.strip() for label in labels.split(",")]
+    project = load_tasks(tasks, wsl2, api)
+    labels = merge_labels(project, labels, merge_label)
+    project = prepare_project(project, labels)
+    project.summary()
+    pack_project_fn(project, output_dir)
 
 
 @cli.command()
@@ -146,6 +558,15 @@ def train_object_detector(tasks: str,
               is_flag=True,
               default=False,
               help="Append NV to the detected labels")
+@click.option("--compile",
+              "compile_model",
+              is_flag=True,
+              default=False,
+              help="Compile the backbone with torch.compile (falls back to eager mode if it fails or is not faster)")
+@click.option("--optimized",
+              is_flag=True,
+              default=False,
+              help="Use the model optimised for CPU by the optimize command")
 @click.option("--wsl2",
               is_flag=True,
               default=False,
@@ -155,17 +576,10 @@ def train_object_detector(tasks: str,
               default="v1",
               show_default=True,
               help='CVAT api version string, v1 or v2')
-def infer_object_detector(tasks, model_dir, model, threshold, batch_size, nv, wsl2, api):
+def infer_object_detector(tasks, model_dir, model, threshold, batch_size, nv, compile_model, optimized, wsl2, api):
     tasks = [int(task) for task in tasks.split(",")]
-    model_path = os.path.join(model_dir, model, "model.pt")
-    labels_path = os.path.join(model_dir, model, "labels.txt")
-
-    labels = []
-    with open(labels_path) as fp:
-        for line in fp.readlines():
-            parts = line.split(",")
-            if len(parts) > 0:
-                labels.append(parts[1].strip())
+    model_path = os.path.join(model_dir, model, OPTIMIZED_MODEL_FILENAME if optimized else "model.pt")
+    labels = load_model_labels(os.path.join(model_dir, model))
 
     for task in tasks:
         task = CvatTask("http://cvat:8080",
@@ -179,7 +593,8 @@ def infer_object_detector(tasks, model_dir, model, threshold, batch_size, nv, ws
                         labels,
                         threshold,
                         batch_size,
-                        nv)
+                        nv,
+                        compile_model)
         project.summary()
         task.add_shapes(project)
 
@@ -203,7 +618,15 @@ def infer_object_detector(tasks, model_dir, model, threshold, batch_size, nv, ws
               default="v1",
               show_default=True,
               help='CVAT api version string, v1 or v2')
-def crop_objects(tasks, output_dir, wsl2, api):
+@click.option('--crop-format',
+              type=click.Choice(list(CROP_FORMATS.keys())),
+              default=None,
+              help='Crop output format (default is the format of the original image)')
+@click.option('--compression-level',
+              type=int,
+              default=None,
+              help='Compression level, 0-9 for png / tiff, quality 1-100 for jpeg (default depends on format)')
+def crop_objects(tasks, output_dir, wsl2, api, crop_format, compression_level):
     tasks = [int(task) for task in tasks.split(",")]
     output_dir = os.path.join(output_dir, now_as_str() + "_" + "_".join([str(task) for task in tasks]))
     for task in tasks:
@@ -213,7 +636,7 @@ def crop_objects(tasks, output_dir, wsl2, api):
                         api=api,
                         debug=True)
         task.load()
-        crop_objects_fn(task.project, output_dir)
+        crop_objects_fn(task.project, output_dir, crop_format=crop_format, compression_level=compression_level)
 
 
 @cli.command()
@@ -235,22 +658,193 @@ def crop_objects(tasks, output_dir, wsl2, api):
               help='Detection threshold')
 @click.option('--batch-size', type=int, default=2,
               help='Batch size for training (reduce if getting out-of-memory errors')
-def infer_object_detector_directory(input_dir, output_dir, model_dir, model, threshold, batch_size):
-    model_path = os.path.join(model_dir, model, "model.pt")
-    labels_path = os.path.join(model_dir, model, "labels.txt")
-    labels = []
-    with open(labels_path) as fp:
-        for line in fp.readlines():
-            parts = line.split(",")
-            if len(parts) > 0:
-                labels.append(parts[1].strip())
-
-    project = infer_directory_fn(input_dir, model_path, labels, threshold, batch_size)
+@click.option('--crop-format',
+              type=click.Choice(list(CROP_FORMATS.keys())),
+              default=None,
+              help='Crop output format (default is the format of the original image)')
+@click.option('--compression-level',
+              type=int,
+              default=None,
+              help='Compression level, 0-9 for png / tiff, quality 1-100 for jpeg (default depends on format)')
+@click.option("--compile",
+              "compile_model",
+              is_flag=True,
+              default=False,
+              help="Compile the backbone with torch.compile (falls back to eager mode if it fails or is not faster)")
+@click.option("--optimized",
+              is_flag=True,
+              default=False,
+              help="Use the model optimised for CPU by the optimize command")
+def infer_object_detector_directory(input_dir, output_dir, model_dir, model, threshold, batch_size, crop_format,
+                                    compression_level, compile_model, optimized):
+    model_path = os.path.join(model_dir, model, OPTIMIZED_MODEL_FILENAME if optimized else "model.pt")
+    labels = load_model_labels(os.path.join(model_dir, model))
+
+    project = infer_directory_fn(input_dir, model_path, labels, threshold, batch_size, compile_model)
 
     # crops_dir = Path(input_dir).joinpath("crops")
     # crops_dir.mkdir(parents=True, exist_ok=True)
     Path(output_dir).mkdir(parents=True, exist_ok=True)
-    crop_objects_fn(project, output_dir, relative_to=input_dir)
+    crop_objects_fn(project,
+                    output_dir,
+                    relative_to=input_dir,
+                    crop_format=crop_format,
+                    compression_level=compression_level)
+
+
+@cli.command()
+@click.option('--tasks', type=str,
+              default=None,
+              help='List of task ids to take the crops from')
+@click.option('-i', '--input-dir', type=str,
+              default=None,
+              help='Directory of images to take the crops from (uses the whole image as the crop)')
+@click.option('--max-images',
+              type=int,
+              default=20,
+              show_default=True,
+              help='Maximum number of images to take crops from')
+@click.option('--compression-level',
+              type=int,
+              default=None,
+              help='Compression level, 0-9 for png / tiff, quality 1-100 for jpeg (default depends on format)')
+@click.option("--wsl2",
+              is_flag=True,
+              default=False,
+              help="Running this on a windows machine using WSL2 instead of docker")
+@click.option('--api',
+              type=str,
+              default="v1",
+              show_default=True,
+              help='CVAT api version string, v1 or v2')
+def benchmark_crop_encoding(tasks, input_dir, max_images, compression_level, wsl2, api):
+    if tasks is not None:
+        project = load_tasks(tasks, wsl2, api)
+    elif input_dir is not None:
+        project = Project.from_directory(input_dir)
+        for image in project.image_dict.values():
+            with Image.open(image.full_path) as im:
+                width, height = im.size
+            image.boxes.append(RectangleAnnotation(0, 0, width, height, "image"))
+    else:
+        raise click.UsageError("Either --tasks or --input-dir must be given")
+    benchmark_crop_formats(project, max_images=max_images, compression_level=compression_level)
+
+
+@cli.command()
+@click.option('--tasks', type=str,
+              default=None,
+              help='List of task ids to load the images from')
+@click.option('-i', '--input-dir', type=str,
+              default=None,
+              help='Directory of images to load')
+@click.option('--batch-size', type=int, default=2,
+              show_default=True,
+              help='Batch size')
+@click.option('--num-batches', type=int, default=50,
+              show_default=True,
+              help='Number of batches loaded for each setting (per epoch)')
+@click.option('--max-workers', type=int, default=None,
+              help='Maximum number of workers to try (default is the number of cores)')
+@click.option('--min-size', type=int, default=800,
+              show_default=True,
+              help='Min size of the model transform, large JPEGs are decoded at a reduced size as in training')
+@click.option('--max-size', type=int, default=1333,
+              show_default=True,
+              help='Max size of the model transform')
+@click.option('-o', '--output', type=str, default=None,
+              help=f'File to save the best settings to (default is ${LOADER_CONFIG_ENV} or ~/.config/miso/loader.json)')
+@click.option("--wsl2",
+              is_flag=True,
+              default=False,
+              help="Running this on a windows machine using WSL2 instead of docker")
+@click.option('--api',
+              type=str,
+              default="v1",
+              show_default=True,
+              help='CVAT api version string, v1 or v2')
+def bench_loader(tasks, input_dir, batch_size, num_batches, max_workers, min_size, max_size, output, wsl2, api):
+    if tasks is not None:
+        project = prepare_project(load_tasks(tasks, wsl2, api))
+    elif input_dir is not None:
+        project = Project.from_directory(input_dir)
+    else:
+        raise click.UsageError("Either --tasks or --input-dir must be given")
+    select_fastest_decoders([image.full_path for image in project.image_dict.values()])
+    project.update_image_sizes()
+    dataset = ObjectDetectionDataset(project, get_transforms(train=True), min_size=min_size, max_size=max_size)
+    best, _ = benchmark_loader(dataset, batch_size=batch_size, num_batches=num_batches, max_workers=max_workers)
+    save_loader_config(best, output)
+    print(f"Saved to {output if output is not None else loader_config_path()}")
+
+
+@cli.command()
+@click.option('--tasks', type=str,
+              prompt='List of task ids of the reference project',
+              help='List of task ids of the reference project, with the ground truth boxes')
+@click.option('--model-dir',
+              type=str,
+              default="/obj_det/models",
+              show_default=True,
+              help='Directory containing models')
+@click.option('--models', type=str,
+              prompt='Names of the folders containing the models separated by commas',
+              help='Names of the folders containing the models separated by commas')
+@click.option('--batch-size', type=int, default=2,
+              show_default=True,
+              help='Batch size')
+@click.option('--max-images', type=int, default=None,
+              help='Maximum number of images to evaluate on')
+@click.option("--wsl2",
+              is_flag=True,
+              default=False,
+              help="Running this on a windows machine using WSL2 instead of docker")
+@click.option('--api',
+              type=str,
+              default="v1",
+              show_default=True,
+              help='CVAT api version string, v1 or v2')
+def compare_models(tasks, model_dir, models, batch_size, max_images, wsl2, api):
+    project = load_tasks(tasks, wsl2, api)
+    model_dirs = [os.path.join(model_dir, model.strip()) for model in models.split(",")]
+    compare_models_fn(project, model_dirs, batch_size=batch_size, max_images=max_images)
+
+
+@cli.command()
+@click.option('--model-dir',
+              type=str,
+              default="/obj_det/models",
+              show_default=True,
+              help='Directory containing models')
+@click.option('--model', type=str,
+              prompt='Name of folder containing model',
+              help='Name of folder containing model')
+@click.option('--tasks', type=str,
+              default=None,
+              help='List of task ids to take the sample images from')
+@click.option('-i', '--input-dir', type=str,
+              default=None,
+              help='Directory to take the sample images from')
+@click.option('--num-images', type=int, default=4,
+              show_default=True,
+              help='Number of sample images to check and time the optimised model on')
+@click.option("--wsl2",
+              is_flag=True,
+              default=False,
+              help="Running this on a windows machine using WSL2 instead of docker")
+@click.option('--api',
+              type=str,
+              default="v1",
+              show_default=True,
+              help='CVAT api version string, v1 or v2')
+def optimize(model_dir, model, tasks, input_dir, num_images, wsl2, api):
+    if tasks is not None:
+        project = load_tasks(tasks, wsl2, api)
+    elif input_dir is not None:
+        project = Project.from_directory(input_dir)
+    else:
+        raise click.UsageError("Either --tasks or --input-dir must be given")
+    optimize_model(os.path.join(model_dir, model), project, num_images=num_images)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+import os
+import random
+
+import numpy as np
+import torch
+
+CHECKPOINT_FILENAME = "checkpoint.pt"
+
+
+def _rng_states():
+    states = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state()
+    }
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def _set_rng_states(states):
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def save_checkpoint(path, epoch, labels, model, optimizer, lr_scheduler, scaler=None, best_model_state=None):
+    """
+    Save the training state at the end of an epoch
+
+    The checkpoint is written to a temporary file first and then renamed, so a run that is stopped while saving
+    still has the previous checkpoint.
+
+    :param path: checkpoint file
+    :param epoch: epoch that has just finished
+    :param labels: labels of the model, checked when resuming
+    :param model: model
+    :param optimizer: optimizer
+    :param lr_scheduler: AdaptiveLearningRateScheduler
+    :param scaler: optional GradScaler for mixed precision
+    :param best_model_state: optional state dict of the model with the best validation metric
+    """
+    checkpoint = {
+        "epoch": epoch,
+        "labels": list(labels),
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "lr_scheduler": lr_scheduler.state_dict(),
+        "scaler": scaler.state_dict() if scaler is not None else None,
+        "best_model": best_model_state,
+        "rng_states": _rng_states()
+    }
+    tmp_path = path + ".tmp"
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, labels, model, optimizer, lr_scheduler, scaler=None):
+    """
+    Restore the training state saved by save_checkpoint
+
+    :return: the epoch to start training from, and the best model state dict (or None)
+    """
+    checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+    if checkpoint["labels"] != list(labels):
+        raise ValueError(f"The checkpoint at {path} was trained with labels {checkpoint['labels']}, not {list(labels)}")
+    model.load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+    if scaler is not None and checkpoint["scaler"] is not None:
+        scaler.load_state_dict(checkpoint["scaler"])
+    _set_rng_states(checkpoint["rng_states"])
+    return checkpoint["epoch"] + 1, checkpoint.get("best_model")
@@ -1,19 +1,111 @@
+import io
 from pathlib import Path
 import os
+import time
+import numpy as np
 import skimage.io as skio
 from tqdm import tqdm
 from miso.object_detection.dataset.project import Project
+from miso.shared.decode import decode_image, select_fastest_decoders
 from miso.shared.utils import now_as_str
 
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
 
-def crop_objects(project: Project, output_dir: str, relative_to=None):
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# Crop output formats and their file extensions
+CROP_FORMATS = {
+    "png": ".png",
+    "jpeg": ".jpg",
+    "tiff": ".tif",
+    "npy": ".npy"
+}
+
+# Compression level used when none is given
+# - png / tiff: zlib level (0 - 9), low levels are much faster and still lossless
+# - jpeg: quality (1 - 100)
+DEFAULT_COMPRESSION_LEVEL = {
+    "png": 1,
+    "jpeg": 95,
+    "tiff": 1,
+    "npy": None
+}
+
+
+def encode_crop(crop: np.ndarray, crop_format: str, compression_level: int = None) -> bytes:
+    """
+    Encode a crop to bytes in the given format
+
+    PNG and JPEG are encoded with imagecodecs if it is installed, as it is much faster than the
+    skimage / PIL encoders. TIFF uses tifffile with zlib compression, NPY is uncompressed.
+
+    :param crop: image array (H x W or H x W x C)
+    :param crop_format: one of "png", "jpeg", "tiff" or "npy"
+    :param compression_level: zlib level for png / tiff, quality for jpeg
+    :return: encoded bytes
+    """
+    if crop_format not in CROP_FORMATS:
+        raise ValueError(f"Crop format must be one of {list(CROP_FORMATS.keys())}")
+    if compression_level is None:
+        compression_level = DEFAULT_COMPRESSION_LEVEL[crop_format]
+    crop = np.ascontiguousarray(crop)
+
+    if crop_format == "png":
+        if imagecodecs is not None:
+            return imagecodecs.png_encode(crop, level=compression_level)
+        return _encode_with_imageio(crop, ".png", compress_level=compression_level)
+    elif crop_format == "jpeg":
+        if crop.dtype != np.uint8:
+            raise ValueError("JPEG crops must be 8-bit, use png, tiff or npy for higher bit depths")
+        if imagecodecs is not None:
+            return imagecodecs.jpeg8_encode(crop, level=compression_level)
+        return _encode_with_imageio(crop, ".jpg", quality=compression_level)
+    elif crop_format == "tiff":
+        if tifffile is None:
+            raise ValueError("TIFF crops need tifffile, install it or use png or npy")
+        buffer = io.BytesIO()
+        if compression_level > 0:
+            tifffile.imwrite(buffer, crop, compression="zlib", compressionargs={"level": compression_level})
+        else:
+            tifffile.imwrite(buffer, crop)
+        return buffer.getvalue()
+    else:
+        buffer = io.BytesIO()
+        np.save(buffer, crop)
+        return buffer.getvalue()
+
+
+def _encode_with_imageio(crop, extension, **kwargs):
+    import imageio.v3 as iio
+    return iio.imwrite("<bytes>", crop, extension=extension, **kwargs)
+
+
+def save_crop(path: str, crop: np.ndarray, crop_format: str = None, compression_level: int = None):
+    """
+    Save a crop to disk. If no format is given the crop is saved with skimage using the extension of the path.
+    """
+    if crop_format is None:
+        skio.imsave(path, crop, check_contrast=False)
+        return
+    with open(path, "wb") as fp:
+        fp.write(encode_crop(crop, crop_format, compression_level))
+
+
+def crop_objects(project: Project, output_dir: str, relative_to=None, crop_format=None, compression_level=None):
     os.makedirs(output_dir, exist_ok=True)
     output_path = Path(output_dir)
+    select_fastest_decoders([image.full_path for image in project.image_dict.values() if len(image.boxes) > 0])
 
     for image in tqdm(project.image_dict.values()):
         if len(image.boxes) == 0:
             continue
-        im = skio.imread(image.full_path)
+        im = decode_image(image.full_path)
         for box in image.boxes:
             if relative_to is not None:
                 label_path = output_path / Path(image.full_path).relative_to(relative_to).parent / box.label
@@ -29,6 +121,65 @@ def crop_objects(project: Project, output_dir: str, relative_to=None):
             s = box.bounds
             crop = im[c[1]:c[3], c[0]:c[2], ...]
             path = Path(image.full_path)
-            filename = f"{path.stem}_{s[0]:.0f}_{s[1]:.0f}_{s[2]:.0f}_{s[3]:.0f}{path.suffix}"
-            skio.imsave(os.path.join(str(label_path), filename), crop, check_contrast=False)
+            suffix = path.suffix if crop_format is None else CROP_FORMATS[crop_format]
+            filename = f"{path.stem}_{s[0]:.0f}_{s[1]:.0f}_{s[2]:.0f}_{s[3]:.0f}{suffix}"
+            save_crop(os.path.join(str(label_path), filename), crop, crop_format, compression_level)
+
+
+def benchmark_crop_formats(project: Project, max_images=20, compression_level=None, crop_formats=None):
+    """
+    Measure the encode throughput of each crop format using the crops of the first images in the project
+
+    Nothing is written to disk, the crops are only encoded in memory.
+
+    :param project: project containing the images and boxes to crop
+    :param max_images: maximum number of images (with boxes) to take crops from
+    :param compression_level: compression level passed to each encoder (default per format if None)
+    :param crop_formats: formats to test (all if None)
+    :return: dictionary of format -> results
+    """
+    if crop_formats is None:
+        crop_formats = list(CROP_FORMATS.keys())
 
+    # Load the crops once so that only encoding is timed
+    crops = []
+    images = [image for image in project.image_dict.values() if len(image.boxes) > 0][:max_images]
+    for image in tqdm(images):
+        im = decode_image(image.full_path)
+        for box in image.boxes:
+            c = box.coords_int
+            crop = im[c[1]:c[3], c[0]:c[2], ...]
+            if crop.size > 0:
+                crops.append(crop)
+    if len(crops) == 0:
+        raise ValueError("No crops found in the project to benchmark")
+    raw_bytes = sum(crop.nbytes for crop in crops)
+
+    print("-" * 80)
+    print("Crop encoding benchmark")
+    print(f"- images: {len(images)}")
+    print(f"- crops: {len(crops)}")
+    print(f"- raw size: {raw_bytes / 1e6:.1f} MB")
+    print(f"- imagecodecs: {'yes' if imagecodecs is not None else 'no'}")
+    print("-" * 80)
+    print(f"{'format':<8}{'level':>8}{'crops/s':>12}{'MB/s':>12}{'ratio':>10}")
+    results = {}
+    for crop_format in crop_formats:
+        level = compression_level if compression_level is not None else DEFAULT_COMPRESSION_LEVEL[crop_format]
+        try:
+            start = time.perf_counter()
+            encoded_bytes = sum(len(encode_crop(crop, crop_format, level)) for crop in crops)
+            elapsed = max(time.perf_counter() - start, 1e-9)
+        except Exception as e:
+            print(f"{crop_format:<8}{'':>8}  failed: {e}")
+            continue
+        results[crop_format] = {
+            "level": level,
+            "crops_per_second": len(crops) / elapsed,
+            "mb_per_second": raw_bytes / 1e6 / elapsed,
+            "compression_ratio": raw_bytes / max(encoded_bytes, 1)
+        }
+        r = results[crop_format]
+        print(f"{crop_format:<8}{str(level):>8}{r['crops_per_second']:>12.1f}{r['mb_per_second']:>12.1f}{r['compression_ratio']:>10.2f}")
+    print("-" * 80)
+    return results
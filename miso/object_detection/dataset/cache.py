@@ -0,0 +1,101 @@
+import multiprocessing
+
+import numpy as np
+import torch
+
+# Columns of the cache table
+_OFFSET = 0
+_NBYTES = 1
+_HEIGHT = 2
+_WIDTH = 3
+_CHANNELS = 4
+
+
+class SharedImageCache(object):
+    def __init__(self, num_images: int, max_bytes: int, mode="decoded"):
+        """
+        Image cache in shared memory with a fixed byte budget
+
+        The storage and index are torch tensors in shared memory, so DataLoader workers started after the cache
+        is created (and any later epochs) all read and write the same cache.
+
+        Images are admitted until the budget is full and then kept. Training visits every image once per epoch
+        in a random order, so evicting the least recently used image would only throw away an image that is
+        needed again later in the epoch. Keeping the first images that fit gives a hit rate of
+        budget / dataset size on every epoch after the first, and 100% if the whole dataset fits.
+
+        :param num_images: number of images in the dataset, images are cached by dataset index
+        :param max_bytes: cache budget in bytes
+        :param mode: "decoded" to cache uint8 image arrays, "encoded" to cache the raw file bytes
+        """
+        if mode not in ["decoded", "encoded"]:
+            raise ValueError("Cache mode must be one of 'decoded' or 'encoded'")
+        self.mode = mode
+        self.max_bytes = int(max_bytes)
+        self.storage = torch.empty(self.max_bytes, dtype=torch.uint8).share_memory_()
+        # offset, number of bytes, height, width, channels for each image (offset -1 if not cached)
+        self.table = torch.full((num_images, 5), -1, dtype=torch.int64).share_memory_()
+        # bytes used, hits, misses
+        self.counters = torch.zeros(3, dtype=torch.int64).share_memory_()
+        # A spawn context lock can be shared with both forked DataLoader workers and spawned training processes
+        self.lock = multiprocessing.get_context("spawn").Lock()
+
+    def get(self, idx):
+        """
+        Get an image from the cache
+
+        :return: uint8 array (decoded mode) or bytes (encoded mode), or None if the image is not cached
+        """
+        offset, nbytes, height, width, channels = self.table[idx].tolist()
+        if offset < 0:
+            self.counters[2] += 1
+            return None
+        self.counters[1] += 1
+        data = self.storage[offset:offset + nbytes].numpy()
+        if self.mode == "encoded":
+            return data.tobytes()
+        if channels == 0:
+            return data.reshape(height, width)
+        return data.reshape(height, width, channels)
+
+    def put(self, idx, data):
+        """
+        Add an image to the cache if there is room in the budget
+
+        :param idx: dataset index of the image
+        :param data: uint8 array (decoded mode) or bytes (encoded mode)
+        :return: True if the image was added
+        """
+        if self.mode == "encoded":
+            array = np.frombuffer(data, dtype=np.uint8)
+            shape = (0, 0, 0)
+        else:
+            if data.dtype != np.uint8:
+                raise ValueError("Only uint8 images can be cached")
+            array = np.ascontiguousarray(data).reshape(-1)
+            shape = (data.shape[0], data.shape[1], data.shape[2] if data.ndim == 3 else 0)
+        nbytes = array.size
+        with self.lock:
+            if self.table[idx, _OFFSET] >= 0:
+                return True
+            offset = int(self.counters[0])
+            if offset + nbytes > self.max_bytes:
+                return False
+            self.storage[offset:offset + nbytes].numpy()[:] = array
+            self.table[idx, _NBYTES] = nbytes
+            self.table[idx, _HEIGHT] = shape[0]
+            self.table[idx, _WIDTH] = shape[1]
+            self.table[idx, _CHANNELS] = shape[2]
+            # Offset is written last so that readers never see a partially written entry
+            self.table[idx, _OFFSET] = offset
+            self.counters[0] = offset + nbytes
+        return True
+
+    def __len__(self):
+        return int((self.table[:, _OFFSET] >= 0).sum())
+
+    def summary(self):
+        used, hits, misses = self.counters.tolist()
+        total = max(hits + misses, 1)
+        print(f"Image cache ({self.mode}): {len(self)}/{len(self.table)} images, "
+              f"{used / 1e9:.2f}/{self.max_bytes / 1e9:.2f} GB, hit rate {hits / total:.1%}")
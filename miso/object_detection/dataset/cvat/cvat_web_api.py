@@ -184,6 +184,7 @@ class CvatTask(object):
         self.label_dict_by_name = dict()
         self.debug = debug
         self.frames = []
+        self.frame_sizes = []
         self.tracks = dict()
         if api == 'v1':
             self.api = "api/v1"
@@ -224,10 +225,11 @@ class CvatTask(object):
             print(f"- {len(self.frames)} images")
         frame_keys = []
         for idx, frame in enumerate(self.frames):
+            width, height = self.frame_sizes[idx]
             if os.path.exists(os.path.join(self.image_root, frame)):
-                image = ImageMetadata(frame, self.image_root, self.task_id, idx)
+                image = ImageMetadata(frame, self.image_root, self.task_id, idx, width=width, height=height)
             elif os.path.exists(os.path.join("/home/django/share", frame)):
-                image = ImageMetadata(frame, "/home/django/share", self.task_id, idx)
+                image = ImageMetadata(frame, "/home/django/share", self.task_id, idx, width=width, height=height)
             else:
                 print(f"Image {frame} could not be found.")
                 continue
@@ -356,6 +358,7 @@ class CvatTask(object):
         if self.debug:
             print(f"- {len(frames)} frames")
         self.frames = frames
+        self.frame_sizes = [(frame.get('width'), frame.get('height')) for frame in data["frames"]]
 
     def _get_annotations(self):
         url = f"{self.server}/{self.api}/tasks/{self.task_id}/annotations"
@@ -1,51 +1,284 @@
+import os
+
 import numpy as np
 import torch
 import torch.utils.data
-from PIL import Image
 
+from miso.object_detection.dataset.cache import SharedImageCache
+from miso.object_detection.dataset.pack import PACK_IMAGES_FILENAME, is_pack_current, load_pack_index
 from miso.object_detection.dataset.project import Project
+from miso.object_detection.engine.coco_utils import convert_targets_to_coco_api
+from miso.shared.decode import decode_image, decode_region, reduced_size, to_rgb8
 
 
 class ObjectDetectionDataset(torch.utils.data.Dataset):
-    def __init__(self, project: Project, transforms):
+    def __init__(self, project: Project, transforms, cache: SharedImageCache = None, min_size=None, max_size=None):
+        """
+        Object detection dataset of the images in a project
+
+        :param project: project with the images and boxes
+        :param transforms: transforms to apply
+        :param cache: optional shared image cache
+        :param min_size: min size of the model transform, if given with max_size, large JPEGs are decoded at a
+        reduced scale, the boxes are scaled to match and target["scale"] is the (x, y) scale of the image
+        :param max_size: max size of the model transform
+        """
         self.project = project
         self.images = list(project.image_dict.values())
         self.cls_labels = project.label_names
         self.transforms = transforms
+        self.cache = cache
+        self.min_size = min_size
+        self.max_size = max_size
+        # Targets are precomputed so that __getitem__ only has to decode and transform
+        # - the boxes of image i are boxes[box_offsets[i]:box_offsets[i + 1]]
+        self.box_offsets, self.boxes, self.labels = project.box_arrays(self.cls_labels)
+        self.areas = (self.boxes[:, 3] - self.boxes[:, 1]) * (self.boxes[:, 2] - self.boxes[:, 0])
+        # COCO ground truth for evaluation, for each set of indices it has been requested for
+        self._coco_apis = dict()
+
+    def _draft_size(self, idx):
+        if self.min_size is None or self.max_size is None:
+            return None
+        return reduced_size(*self.images[idx].size, self.min_size, self.max_size)
+
+    def _load_image(self, idx):
+        # Decoded RGB image as a uint8 array, from the cache if possible
+        path = self.images[idx].full_path
+        draft_size = self._draft_size(idx)
+        if self.cache is None:
+            return to_rgb8(decode_image(path, draft_size=draft_size))
+        data = self.cache.get(idx)
+        if self.cache.mode == "decoded":
+            if data is None:
+                data = to_rgb8(decode_image(path, draft_size=draft_size))
+                self.cache.put(idx, data)
+            return data
+        if data is None:
+            with open(path, "rb") as fp:
+                data = fp.read()
+            self.cache.put(idx, data)
+        return to_rgb8(decode_image(path, data, draft_size=draft_size))
 
     def __getitem__(self, idx):
-        cvat_image = self.images[idx]
-        img = Image.open(cvat_image.full_path).convert("RGB")
+        # Returns the index of the image rather than its ImageMetadata, so that the metadata and all its
+        # annotations are not pickled from the workers for every batch, use self.images[idx] to get it
+        img = self._load_image(idx)
+
+        # Copies, as the transforms modify the boxes in place
+        start, end = self.box_offsets[idx], self.box_offsets[idx + 1]
+        target = {}
+        target["boxes"] = torch.tensor(self.boxes[start:end])
+        target["labels"] = torch.tensor(self.labels[start:end])
+        target["image_id"] = torch.tensor([idx])
+        target["area"] = torch.tensor(self.areas[start:end])
+        # All instances are not crowd
+        target["iscrowd"] = torch.zeros((end - start,), dtype=torch.int64)
+
+        # Scale the boxes if the image was decoded at a reduced size
+        if self.min_size is not None and self.max_size is not None:
+            width, height = self.images[idx].size
+            scale = torch.tensor([img.shape[1] / width, img.shape[0] / height], dtype=torch.float32)
+            target["boxes"] *= scale.repeat(2)
+            target["area"] *= scale[0] * scale[1]
+            target["scale"] = scale
+
+        if self.transforms is not None:
+            img, target = self.transforms(img, target)
+
+        return img, target, idx
+
+    def get_height_and_width(self, idx):
+        # Original image size from the project (read from the file header if not known), without decoding
+        width, height = self.images[idx].size
+        return height, width
+
+    def _coco_target(self, idx):
+        # Image id, height, width, boxes, labels and areas of an image in original image coordinates
+        height, width = self.get_height_and_width(idx)
+        start, end = self.box_offsets[idx], self.box_offsets[idx + 1]
+        return idx, height, width, self.boxes[start:end], self.labels[start:end], self.areas[start:end]
+
+    def get_coco_api(self, indices=None):
+        """
+        COCO ground truth of the dataset from the project boxes and image sizes, without decoding the images
 
-        boxes = np.asarray([box.coords for box in cvat_image.boxes])
-        labels = np.asarray([self.cls_labels.index(box.label) + 1 for box in cvat_image.boxes])
-        # print(labels)
+        The boxes are in original image coordinates, also if the images are decoded at a reduced size (evaluate maps
+        the predictions back using target["scale"]). The result is kept, so it is only built once for each subset.
+
+        :param indices: indices of the images to include (default all)
+        """
+        if indices is None:
+            indices = range(len(self))
+        key = tuple(indices)
+        if key not in self._coco_apis:
+            self._coco_apis[key] = convert_targets_to_coco_api(self._coco_target(idx) for idx in indices)
+        return self._coco_apis[key]
+
+    def __getstate__(self):
+        # The COCO ground truth is only used in the main process, don't copy it to the workers
+        state = self.__dict__.copy()
+        state["_coco_apis"] = dict()
+        return state
+
+    def __len__(self):
+        return len(self.images)
 
-        boxes = torch.as_tensor(boxes, dtype=torch.float32)
-        labels = torch.as_tensor(labels, dtype=torch.int64)
 
-        image_id = torch.tensor([idx])
+class PackedObjectDetectionDataset(ObjectDetectionDataset):
+    def __init__(self, project: Project, pack_dir: str, transforms):
+        """
+        Dataset that reads the images, boxes and labels from a pack created with pack_project
 
-        # Bounding box areas
-        if len(boxes) > 0:
-            area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
+        The images are read directly from the memory-mapped pack file, there is no decoding.
+
+        :param project: the project the pack was created from
+        :param pack_dir: pack directory
+        :param transforms: transforms to apply
+        """
+        super().__init__(project, transforms)
+        if not is_pack_current(project, pack_dir):
+            raise ValueError(f"The pack at {pack_dir} does not match the project, it needs to be packed again")
+        self.pack_dir = pack_dir
+        index = load_pack_index(pack_dir)
+        self.offsets = index["offsets"]
+        self.shapes = index["shapes"]
+        self._data = None
+
+    @property
+    def data(self):
+        # Opened on first use so that each DataLoader worker maps the file itself
+        if self._data is None:
+            self._data = np.memmap(os.path.join(self.pack_dir, PACK_IMAGES_FILENAME), dtype=np.uint8, mode="c")
+        return self._data
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_data"] = None
+        return state
+
+    def _load_image(self, idx):
+        offset = self.offsets[idx]
+        shape = self.shapes[idx]
+        return self.data[offset:offset + np.prod(shape)].reshape(shape)
+
+    def get_height_and_width(self, idx):
+        return int(self.shapes[idx][0]), int(self.shapes[idx][1])
+
+
+class PatchObjectDetectionDataset(ObjectDetectionDataset):
+    def __init__(self,
+                 project: Project,
+                 transforms,
+                 patch_size=1024,
+                 image_indices=None,
+                 background_fraction=0.25,
+                 jitter=True,
+                 min_visibility=0.5,
+                 cache: SharedImageCache = None):
+        """
+        Dataset of fixed size windows of the images in a project, for training at native resolution on images
+        that are too large to fit in a batch
+
+        There is one window centred on each box, and background_fraction windows per box at random positions.
+        The boxes of every object in a window are clipped to it, objects with less than min_visibility of their
+        area inside the window are dropped. Only the window is decoded if the image format allows it
+        (see decode_region), unless a cache is given, in which case the whole image is decoded and cached.
+
+        The image sizes must be known, see Project.update_image_sizes.
+
+        :param project: project with the images and boxes
+        :param transforms: transforms to apply
+        :param patch_size: window size in pixels, images smaller than this are not padded
+        :param image_indices: indices of the images in the project to take windows from (default all)
+        :param background_fraction: number of random windows per box window
+        :param jitter: move the box windows randomly so that the box is not always in the centre
+        :param min_visibility: minimum fraction of the area of a box inside the window for it to be kept
+        :param cache: optional shared image cache
+        """
+        super().__init__(project, transforms, cache=cache)
+        self.patch_size = patch_size
+        self.jitter = jitter
+        self.min_visibility = min_visibility
+        if image_indices is None:
+            image_indices = range(len(self.images))
+        # (image index, box index) of each window, box index is -1 for background windows
+        self.windows = [(image_idx, box_idx)
+                        for image_idx in image_indices
+                        for box_idx in range(self.box_offsets[image_idx], self.box_offsets[image_idx + 1])]
+        num_background = int(round(background_fraction * len(self.windows)))
+        image_indices = list(image_indices)
+        self.windows.extend((image_indices[i % len(image_indices)], -1) for i in range(num_background))
+
+    def _window(self, image_idx, box_idx):
+        # (x0, y0, x1, y1) of the window, random positions use torch so that each worker has its own seed
+        width, height = self.images[image_idx].size
+        patch_width, patch_height = min(self.patch_size, width), min(self.patch_size, height)
+        if box_idx < 0:
+            x0 = torch.rand(1).item() * (width - patch_width)
+            y0 = torch.rand(1).item() * (height - patch_height)
         else:
-            area = []
+            bx0, by0, bx1, by1 = self.boxes[box_idx]
+            x0 = (bx0 + bx1 - patch_width) / 2
+            y0 = (by0 + by1 - patch_height) / 2
+            if self.jitter:
+                # Keep the box inside the window if it fits
+                x0 += (torch.rand(1).item() - 0.5) * max(patch_width - (bx1 - bx0), 0)
+                y0 += (torch.rand(1).item() - 0.5) * max(patch_height - (by1 - by0), 0)
+        x0 = int(min(max(x0, 0), width - patch_width))
+        y0 = int(min(max(y0, 0), height - patch_height))
+        return x0, y0, x0 + patch_width, y0 + patch_height
 
-        # All instances are not crowd
-        iscrowd = torch.zeros((len(boxes),), dtype=torch.int64)
+    def _load_region(self, image_idx, window):
+        if self.cache is None:
+            return to_rgb8(decode_region(self.images[image_idx].full_path, window))
+        x0, y0, x1, y1 = window
+        return np.ascontiguousarray(self._load_image(image_idx)[y0:y1, x0:x1])
+
+    def _clip_boxes(self, image_idx, window):
+        # Boxes, labels and areas of the objects in the window, with the boxes clipped to it
+        x0, y0, x1, y1 = window
+        start, end = self.box_offsets[image_idx], self.box_offsets[image_idx + 1]
+        boxes = self.boxes[start:end] - np.array([x0, y0, x0, y0], dtype=np.float32)
+        boxes = np.clip(boxes, 0, [x1 - x0, y1 - y0, x1 - x0, y1 - y0]).astype(np.float32).reshape(-1, 4)
+        areas = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
+        keep = ((areas >= self.min_visibility * self.areas[start:end])
+                & (boxes[:, 2] - boxes[:, 0] >= 1)
+                & (boxes[:, 3] - boxes[:, 1] >= 1))
+        return boxes[keep], self.labels[start:end][keep], areas[keep]
+
+    def __getitem__(self, idx):
+        image_idx, box_idx = self.windows[idx]
+        window = self._window(image_idx, box_idx)
+        img = self._load_region(image_idx, window)
+        boxes, labels, areas = self._clip_boxes(image_idx, window)
 
         target = {}
-        target["boxes"] = boxes
-        target["labels"] = labels
-        target["image_id"] = image_id
-        target["area"] = area
-        target["iscrowd"] = iscrowd
+        target["boxes"] = torch.tensor(boxes)
+        target["labels"] = torch.tensor(labels)
+        target["image_id"] = torch.tensor([idx])
+        target["area"] = torch.tensor(areas)
+        target["iscrowd"] = torch.zeros((len(boxes),), dtype=torch.int64)
 
         if self.transforms is not None:
             img, target = self.transforms(img, target)
 
-        return img, target, cvat_image
+        return img, target, image_idx
+
+    def get_height_and_width(self, idx):
+        width, height = self.images[self.windows[idx][0]].size
+        return min(self.patch_size, height), min(self.patch_size, width)
+
+    def _coco_target(self, idx):
+        image_idx, box_idx = self.windows[idx]
+        height, width = self.get_height_and_width(idx)
+        return (idx, height, width) + self._clip_boxes(image_idx, self._window(image_idx, box_idx))
+
+    def get_coco_api(self, indices=None):
+        # Only possible if the windows are always in the same place
+        if self.jitter or any(box_idx < 0 for _, box_idx in self.windows):
+            return None
+        return super().get_coco_api(indices)
 
     def __len__(self):
-        return len(self.images)
+        return len(self.windows)
@@ -3,6 +3,9 @@ import os.path
 import json
 from pathlib import Path
 from typing import List, Union
+
+from PIL import Image
+
 from miso.object_detection.dataset.annotation import RectangleAnnotation
 
 
@@ -12,7 +15,9 @@ class ImageMetadata(object):
                  container,
                  dataset_id=0,
                  frame_id=0,
-                 metadata=None):
+                 metadata=None,
+                 width=None,
+                 height=None):
         # Path to image within the container
         self.path = path
         # Container root directory
@@ -24,6 +29,9 @@ class ImageMetadata(object):
         # Annotations
         # - boxes
         self.boxes: List[RectangleAnnotation] = []
+        # Image size (None if not known yet, see read_size)
+        self.width = width
+        self.height = height
 
         self.metadata = metadata
         if self.metadata is None:
@@ -48,6 +56,18 @@ class ImageMetadata(object):
     def full_path(self):
         return os.path.join(self.container, self.path)
 
+    def read_size(self):
+        # Read the image size from the file header, the image is not decoded
+        with Image.open(self.full_path) as im:
+            self.width, self.height = im.size
+        return self.width, self.height
+
+    @property
+    def size(self):
+        if self.width is None or self.height is None:
+            self.read_size()
+        return self.width, self.height
+
     @property
     def labels(self):
         labels = []
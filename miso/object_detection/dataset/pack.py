@@ -0,0 +1,77 @@
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+from miso.object_detection.dataset.project import Project
+from miso.shared.decode import decode_image, to_rgb8
+
+PACK_IMAGES_FILENAME = "images.bin"
+PACK_INDEX_FILENAME = "index.npz"
+
+
+def _project_arrays(project: Project):
+    # Image ids, label names, box offsets, boxes and labels of a project in the order used by the datasets
+    image_ids = np.asarray([image.id for image in project.image_dict.values()])
+    label_names = np.asarray(project.label_names)
+    box_offsets, boxes, labels = project.box_arrays()
+    return image_ids, label_names, box_offsets, boxes, labels
+
+
+def pack_project(project: Project, output_dir: str):
+    """
+    Decode every image in a project once and write them to a single uint8 file that can be memory-mapped
+
+    The pack directory contains:
+    - images.bin: the RGB images (H x W x 3, uint8) one after another
+    - index.npz: image ids, offsets and shapes of the images in images.bin, and the boxes and labels
+
+    :param project: project to pack, the images are packed in the same order as the project's image_dict
+    :param output_dir: pack directory
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    image_ids, label_names, box_offsets, boxes, labels = _project_arrays(project)
+    images = list(project.image_dict.values())
+    offsets = np.zeros(len(images), dtype=np.int64)
+    shapes = np.zeros((len(images), 3), dtype=np.int64)
+
+    print("-" * 80)
+    print(f"Packing {len(images)} images to {output_dir}")
+    offset = 0
+    with open(os.path.join(output_dir, PACK_IMAGES_FILENAME), "wb") as fp:
+        for i, image in enumerate(tqdm(images)):
+            im = to_rgb8(decode_image(image.full_path))
+            offsets[i] = offset
+            shapes[i] = im.shape
+            fp.write(np.ascontiguousarray(im).tobytes())
+            offset += im.nbytes
+    np.savez(os.path.join(output_dir, PACK_INDEX_FILENAME),
+             image_ids=image_ids,
+             label_names=label_names,
+             offsets=offsets,
+             shapes=shapes,
+             box_offsets=box_offsets,
+             boxes=boxes,
+             labels=labels)
+    print(f"- size: {offset / 1e9:.2f} GB")
+    print("-" * 80)
+
+
+def load_pack_index(pack_dir: str):
+    with np.load(os.path.join(pack_dir, PACK_INDEX_FILENAME)) as index:
+        return {k: index[k] for k in index.files}
+
+
+def is_pack_current(project: Project, pack_dir: str):
+    """
+    Check that a pack contains the same images, labels and boxes as the project
+    """
+    if not os.path.exists(os.path.join(pack_dir, PACK_INDEX_FILENAME)):
+        return False
+    index = load_pack_index(pack_dir)
+    image_ids, label_names, box_offsets, boxes, labels = _project_arrays(project)
+    return (np.array_equal(index["image_ids"], image_ids)
+            and np.array_equal(index["label_names"], label_names)
+            and np.array_equal(index["box_offsets"], box_offsets)
+            and np.array_equal(index["labels"], labels)
+            and np.allclose(index["boxes"], boxes))
@@ -1,5 +1,9 @@
+from pathlib import Path
 from typing import Dict, Union
 
+import numpy as np
+from tqdm import tqdm
+
 from miso.object_detection.dataset.image import ImageMetadata
 from miso.object_detection.dataset.label import Label
 
@@ -91,6 +95,43 @@ class Project(object):
             if key not in self.label_dict:
                 self.label_dict[key] = label
 
+    @staticmethod
+    def from_directory(input_dir: str, extensions=(".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".tif")):
+        # Project of all the images in a directory (recursive), without annotations
+        p = Path(input_dir)
+        if not p.exists():
+            raise ValueError(f"Directory does not exist: {input_dir}")
+        filepaths = [path for path in p.rglob("*.*") if path.suffix.lower() in extensions]
+        project = Project()
+        for i, filepath in enumerate(filepaths):
+            project.add_image(ImageMetadata(filepath, "/", 0, i))
+        return project
+
+    def update_image_sizes(self):
+        # Read the size of any images where it is not known from the file headers
+        images = [image for image in self.image_dict.values() if image.width is None or image.height is None]
+        for image in tqdm(images, disable=len(images) == 0):
+            image.read_size()
+
+    def box_arrays(self, label_names=None):
+        """
+        Boxes and labels of all images as flat arrays, in the order of image_dict
+
+        The boxes of image i are boxes[box_offsets[i]:box_offsets[i + 1]]
+
+        :param label_names: label order, labels are the index in this list + 1 (default is label_names)
+        :return: box_offsets (N + 1), boxes (M x 4, x1 y1 x2 y2), labels (M)
+        """
+        if label_names is None:
+            label_names = self.label_names
+        label_to_idx = {label: i + 1 for i, label in enumerate(label_names)}
+        images = list(self.image_dict.values())
+        box_offsets = np.zeros(len(images) + 1, dtype=np.int64)
+        box_offsets[1:] = np.cumsum([len(image.boxes) for image in images])
+        boxes = np.asarray([box.coords for image in images for box in image.boxes], dtype=np.float32).reshape(-1, 4)
+        labels = np.asarray([label_to_idx[box.label] for image in images for box in image.boxes], dtype=np.int64)
+        return box_offsets, boxes, labels
+
     def box_counts(self):
         counts = {"0": 0,
                   "1-10": 0,
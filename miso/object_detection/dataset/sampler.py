@@ -0,0 +1,132 @@
+import math
+
+import numpy as np
+import torch
+import torch.utils.data
+
+from miso.object_detection.dataset.project import Project
+
+
+def repeat_factors(project: Project, threshold=0.1, indices=None):
+    """
+    LVIS repeat factor of each image in a project
+
+    For each label c, f_c is the fraction of images that contain it and r_c = max(1, sqrt(threshold / f_c)).
+    The repeat factor of an image is the largest r_c of its labels, so images with rare labels are seen more
+    often, and images with only common labels (f_c >= threshold) are seen once per epoch.
+
+    :param project: project with the images and boxes
+    :param threshold: images with labels in less than this fraction of the images are repeated
+    :param indices: indices of the images the label frequencies are computed from, i.e. the images that are
+    sampled (default all)
+    :return: array of the repeat factor of each image, in the order of project.image_dict
+    """
+    images = list(project.image_dict.values())
+    if indices is None:
+        indices = range(len(images))
+    counts = dict()
+    for idx in indices:
+        for label in set(box.label for box in images[idx].boxes):
+            counts[label] = counts.get(label, 0) + 1
+    num_images = max(len(indices), 1)
+    label_factors = {label: max(1.0, math.sqrt(threshold / (count / num_images))) for label, count in counts.items()}
+    return np.asarray([max([label_factors.get(box.label, 1.0) for box in image.boxes], default=1.0)
+                       for image in images])
+
+
+class RepeatFactorSampler(torch.utils.data.Sampler):
+    def __init__(self, repeat_factors, epoch_length=None, seed=0, num_replicas=1, rank=0):
+        """
+        Sampler that repeats each sample according to its repeat factor
+
+        Without an epoch length, each sample is repeated floor(r) times plus once more with probability r - floor(r)
+        (stochastic rounding), so the epoch length varies slightly. With an epoch length, that many samples are
+        drawn with replacement with probability proportional to r, so every epoch is the same length whatever the
+        size of the dataset.
+
+        Call set_epoch at the start of each epoch so that the samples are different each epoch (they are the same
+        for each run with the same seed).
+
+        :param repeat_factors: repeat factor of each sample in the dataset
+        :param epoch_length: number of samples per epoch (default is the sum of the repeat factors on average)
+        :param seed: random seed
+        :param num_replicas: number of processes in distributed training, each gets an equal share of the samples
+        :param rank: rank of this process in distributed training
+        """
+        super().__init__()
+        self.repeat_factors = torch.as_tensor(repeat_factors, dtype=torch.float64)
+        self.epoch_length = epoch_length
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._indices = None
+        self._indices_epoch = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _epoch_indices(self):
+        # Computed once per epoch, so that __len__ matches the samples returned by __iter__
+        if self._indices_epoch != self.epoch:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            if self.epoch_length is not None:
+                indices = torch.multinomial(self.repeat_factors, self.epoch_length, replacement=True,
+                                            generator=generator)
+            else:
+                whole = torch.floor(self.repeat_factors)
+                repeats = whole + (torch.rand(len(self.repeat_factors), generator=generator, dtype=torch.float64)
+                                   < self.repeat_factors - whole)
+                indices = torch.repeat_interleave(torch.arange(len(self.repeat_factors)), repeats.long())
+                indices = indices[torch.randperm(len(indices), generator=generator)]
+            # Every process generates the same indices and takes its share, padded so that all have the same number
+            indices = indices.tolist()
+            num_samples = math.ceil(len(indices) / self.num_replicas)
+            indices += indices[:num_samples * self.num_replicas - len(indices)]
+            self._indices = indices[self.rank::self.num_replicas]
+            self._indices_epoch = self.epoch
+        return self._indices
+
+    def __iter__(self):
+        return iter(self._epoch_indices())
+
+    def __len__(self):
+        return len(self._epoch_indices())
+
+
+def stratified_subset(sample_labels, size, seed=0):
+    """
+    Fixed subset of a dataset with the labels represented as evenly as possible
+
+    Samples are taken in turn from each label (in a random order within each label) until the subset is full, so
+    rare labels are in the subset even if it is small.
+
+    :param sample_labels: labels of each sample in the dataset (a collection of labels per sample)
+    :param size: number of samples in the subset
+    :param seed: random seed
+    :return: sorted list of the indices of the samples in the subset
+    """
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    samples_by_label = dict()
+    for idx, labels in enumerate(sample_labels):
+        for label in set(labels):
+            samples_by_label.setdefault(label, []).append(idx)
+    queues = [[samples[i] for i in torch.randperm(len(samples), generator=generator).tolist()]
+              for label, samples in sorted(samples_by_label.items())]
+    subset = set()
+    size = min(size, len(sample_labels))
+    while len(subset) < size and any(len(queue) > 0 for queue in queues):
+        for queue in queues:
+            while len(queue) > 0 and queue[0] in subset:
+                queue.pop(0)
+            if len(queue) > 0 and len(subset) < size:
+                subset.add(queue.pop(0))
+    # Samples without labels
+    unlabelled = [idx for idx, labels in enumerate(sample_labels) if len(labels) == 0]
+    for i in torch.randperm(len(unlabelled), generator=generator).tolist():
+        if len(subset) >= size:
+            break
+        subset.add(unlabelled[i])
+    return sorted(subset)
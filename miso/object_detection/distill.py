@@ -0,0 +1,100 @@
+import copy
+import os
+from datetime import datetime
+
+import numpy as np
+
+from miso.object_detection.dataset.project import Project
+from miso.object_detection.inference import compare_models, infer, load_model_labels
+from miso.object_detection.training import prepare_project, train
+
+
+def distill(project: Project,
+            teacher_dir: str,
+            output_dir: str = None,
+            name: str = None,
+            arch="fasterrcnn_mobilenet_v3_large_fpn",
+            threshold=0.5,
+            holdout_fraction=0.2,
+            unlabelled_project: Project = None,
+            batch_size=2,
+            **kwargs):
+    """
+    Train a small, fast student model on the detections of a larger teacher model
+
+    The student is trained on the labelled images of the project with their ground truth boxes, plus the unlabelled
+    images (of the project and unlabelled_project) with the detections of the teacher as boxes, which are kept out of
+    the student's test set. The torchvision detectors are trained on box targets, so the detections are used as hard
+    targets: only those with a score above threshold are kept, trading the number of objects learnt from against the
+    number of errors learnt.
+
+    A fraction of the labelled images is held out of the student training set, and the teacher and student are
+    compared on them at the end (the teacher may have been trained on these images, favouring it).
+
+    :param project: project with labelled and unlabelled images
+    :param teacher_dir: directory of the teacher model saved by train
+    :param output_dir: directory to save the student model in
+    :param name: name of the student model (default is the date and time)
+    :param arch: student architecture
+    :param threshold: score threshold of the teacher detections
+    :param holdout_fraction: fraction of the labelled images held out for the comparison
+    :param unlabelled_project: more unlabelled images
+    :param batch_size: batch size for the teacher inference and the student training
+    :param kwargs: other train arguments
+    :return: results of compare_models for the teacher and student
+    """
+    if output_dir is None:
+        output_dir = os.getcwd()
+    if name is None:
+        name = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+    labels = load_model_labels(teacher_dir)
+
+    # Labelled images, some are held out for the comparison
+    labelled = prepare_project(project, labels)
+    keys = list(labelled.image_dict.keys())
+    rng = np.random.default_rng(1)
+    holdout_keys = set(rng.permutation(len(keys))[:int(holdout_fraction * len(keys))].tolist())
+    holdout = copy.deepcopy(labelled)
+    holdout.image_dict = {key: labelled.image_dict[key] for i, key in enumerate(keys) if i in holdout_keys}
+    student_project = copy.deepcopy(labelled)
+    student_project.image_dict = {key: labelled.image_dict[key] for i, key in enumerate(keys) if i not in holdout_keys}
+
+    # Teacher detections on the unlabelled images
+    unlabelled = copy.deepcopy(project)
+    if unlabelled_project is not None:
+        unlabelled.add_project(unlabelled_project)
+    pseudo_labelled = infer(unlabelled, os.path.join(teacher_dir, "model.pt"), labels, threshold, batch_size)
+    pseudo_labelled.remove_unlabelled_images()
+    student_project.add_project(pseudo_labelled)
+
+    print("-" * 80)
+    print("Distillation")
+    print(f"- teacher: {teacher_dir}")
+    print(f"- student architecture: {arch}")
+    print(f"- labelled images: {len(labelled.image_dict) - len(holdout.image_dict)}")
+    print(f"- held out images: {len(holdout.image_dict)}")
+    num_unlabelled = sum(len(image.boxes) == 0 for image in unlabelled.image_dict.values())
+    print(f"- images labelled by the teacher: {len(pseudo_labelled.image_dict)} of {num_unlabelled}"
+          f" unlabelled, {sum(len(image.boxes) for image in pseudo_labelled.image_dict.values())} objects"
+          f" (score > {threshold})")
+
+    # The teacher's detections are only trained on, the student's test set (and early stopping) uses ground truth
+    train(student_project,
+          labels,
+          output_dir=output_dir,
+          name=name,
+          batch_size=batch_size,
+          arch=arch,
+          train_only_images=list(pseudo_labelled.image_dict.keys()),
+          **kwargs)
+
+    # Compare the teacher and student on the held out images
+    if len(holdout.image_dict) == 0:
+        return None
+    student_dir = os.path.join(output_dir, name)
+    results = compare_models(holdout, [teacher_dir, student_dir], batch_size=batch_size)
+    with open(os.path.join(student_dir, "comparison.txt"), "w") as fp:
+        for result in results:
+            fp.write(f"{result['model']},{result['arch']},{result['parameters']},{result['ms_per_image']:.1f},"
+                     f"{result['ap']:.3f},{result['ap50']:.3f}\n")
+    return results
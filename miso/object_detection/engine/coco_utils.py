@@ -152,18 +152,26 @@ def convert_to_coco_api(ds):
     for img_idx in range(len(ds)):
         # find better way to get target
         # targets = ds.get_annotations(img_idx)
-        img, targets, metadatas = ds[img_idx]
+        img, targets, _ = ds[img_idx]
         image_id = targets["image_id"].item()
         img_dict = {}
         img_dict["id"] = image_id
         img_dict["height"] = img.shape[-2]
         img_dict["width"] = img.shape[-1]
-        dataset["images"].append(img_dict)
         bboxes = targets["boxes"].clone()
+        areas = targets["area"].clone()
+        # images decoded at a reduced size, the ground truth is in original image coordinates (see evaluate)
+        if "scale" in targets:
+            scale = targets["scale"]
+            img_dict["height"] = round(img_dict["height"] / scale[1].item())
+            img_dict["width"] = round(img_dict["width"] / scale[0].item())
+            bboxes /= scale.repeat(2)
+            areas /= scale[0] * scale[1]
+        dataset["images"].append(img_dict)
         bboxes[:, 2:] -= bboxes[:, :2]
         bboxes = bboxes.tolist()
         labels = targets["labels"].tolist()
-        areas = targets["area"].tolist()
+        areas = areas.tolist()
         iscrowd = targets["iscrowd"].tolist()
         if "masks" in targets:
             masks = targets["masks"]
@@ -195,15 +203,56 @@ def convert_to_coco_api(ds):
     return coco_ds
 
 
+def convert_targets_to_coco_api(image_targets):
+    """
+    COCO api of ground truth boxes, without loading the images
+
+    :param image_targets: iterable of (image id, height, width, boxes, labels, areas) for each image, with the
+    boxes as an N x 4 array of x0, y0, x1, y1
+    """
+    coco_ds = COCO()
+    # annotation IDs need to start at 1, not 0, see torchvision issue #1530
+    ann_id = 1
+    dataset = {"images": [], "categories": [], "annotations": []}
+    categories = set()
+    for image_id, height, width, boxes, labels, areas in image_targets:
+        dataset["images"].append({"id": int(image_id), "height": int(height), "width": int(width)})
+        for box, label, area in zip(boxes.tolist(), labels.tolist(), areas.tolist()):
+            categories.add(label)
+            dataset["annotations"].append({"image_id": int(image_id),
+                                           "bbox": [box[0], box[1], box[2] - box[0], box[3] - box[1]],
+                                           "category_id": label,
+                                           "area": area,
+                                           "iscrowd": 0,
+                                           "id": ann_id})
+            ann_id += 1
+    dataset["categories"] = [{"id": i} for i in sorted(categories)]
+    coco_ds.dataset = dataset
+    coco_ds.createIndex()
+    return coco_ds
+
+
 def get_coco_api_from_dataset(dataset):
+    # Datasets with a get_coco_api method build the ground truth from their annotations without loading the images,
+    # only for the images in the subset
+    original_dataset = dataset
+    indices = None
     for _ in range(10):
         if isinstance(dataset, torchvision.datasets.CocoDetection):
             break
         if isinstance(dataset, torch.utils.data.Subset):
+            if indices is None:
+                indices = list(dataset.indices)
+            else:
+                indices = [dataset.indices[i] for i in indices]
             dataset = dataset.dataset
     if isinstance(dataset, torchvision.datasets.CocoDetection):
         return dataset.coco
-    return convert_to_coco_api(dataset)
+    if hasattr(dataset, "get_coco_api"):
+        coco = dataset.get_coco_api(indices)
+        if coco is not None:
+            return coco
+    return convert_to_coco_api(original_dataset)
 
 
 class CocoDetection(torchvision.datasets.CocoDetection):
@@ -1,3 +1,4 @@
+import contextlib
 import math
 import sys
 import time
@@ -9,7 +10,15 @@ from miso.object_detection.engine.coco_eval import CocoEvaluator
 from miso.object_detection.engine.coco_utils import get_coco_api_from_dataset
 
 
-def train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq, scaler=None):
+def train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq, scaler=None, autocast_dtype=None,
+                    accumulate_steps=1, telemetry=None):
+    # Gradient accumulation: the gradients of accumulate_steps batches are summed (with the losses divided by
+    # accumulate_steps) before each optimizer step, the warmup is counted in optimizer steps
+    # Mixed precision: autocast to autocast_dtype (float16 if only a scaler is given), scaling the loss if a scaler
+    # is given (needed for float16 on GPU, not for bfloat16)
+    # Telemetry: the times of each iteration are logged if a Telemetry is given
+    if autocast_dtype is None and scaler is not None:
+        autocast_dtype = torch.float16
     model.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter("lr", utils.SmoothedValue(window_size=1, fmt="{value:.6f}"))
@@ -18,20 +27,37 @@ def train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq, sc
     lr_scheduler = None
     if epoch == 0:
         warmup_factor = 1.0 / 1000
-        warmup_iters = min(1000, len(data_loader) - 1)
+        warmup_iters = max(min(1000, len(data_loader) // accumulate_steps - 1), 1)
 
         lr_scheduler = torch.optim.lr_scheduler.LinearLR(
             optimizer, start_factor=warmup_factor, total_iters=warmup_iters
         )
 
-    for images, targets, metadatas in metric_logger.log_every(data_loader, print_freq, header):
+    optimizer.zero_grad()
+    end = time.perf_counter()
+    for i, (images, targets, _) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+        start = time.perf_counter()
         images = list(image.to(device) for image in images)
         # print(targets[0])
         # print(targets[0].keys())
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-        with torch.cuda.amp.autocast(enabled=scaler is not None):
-            loss_dict = model(images, targets)
-            losses = sum(loss for loss in loss_dict.values())
+        step = (i + 1) % accumulate_steps == 0 or i + 1 == len(data_loader)
+        # Only synchronise the gradients between processes on the batches with an optimizer step
+        sync_context = model.no_sync() if not step and hasattr(model, "no_sync") else contextlib.nullcontext()
+        with sync_context:
+            with torch.autocast(device_type=device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                loss_dict = model(images, targets)
+                losses = sum(loss for loss in loss_dict.values())
+            if telemetry is not None:
+                telemetry.synchronize()
+                forward_end = time.perf_counter()
+            if scaler is not None:
+                scaler.scale(losses / accumulate_steps).backward()
+            else:
+                (losses / accumulate_steps).backward()
+            if telemetry is not None:
+                telemetry.synchronize()
+                backward_end = time.perf_counter()
 
         # reduce losses over all GPUs for logging purposes
         loss_dict_reduced = utils.reduce_dict(loss_dict)
@@ -44,20 +70,31 @@ def train_one_epoch(model, optimizer, data_loader, device, epoch, print_freq, sc
             print(loss_dict_reduced)
             sys.exit(1)
 
-        optimizer.zero_grad()
-        if scaler is not None:
-            scaler.scale(losses).backward()
-            scaler.step(optimizer)
-            scaler.update()
-        else:
-            losses.backward()
-            optimizer.step()
-
-        if lr_scheduler is not None:
-            lr_scheduler.step()
+        if step:
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            optimizer.zero_grad()
+
+            if lr_scheduler is not None:
+                lr_scheduler.step()
+
+        if telemetry is not None:
+            telemetry.synchronize()
+            telemetry.log_iteration(epoch,
+                                    i,
+                                    data_time=start - end,
+                                    forward_time=forward_end - start,
+                                    backward_time=backward_end - forward_end,
+                                    step_time=time.perf_counter() - backward_end,
+                                    losses=dict(loss=loss_value, **{k: v.item() for k, v in loss_dict_reduced.items()}),
+                                    lr=optimizer.param_groups[0]["lr"])
 
         metric_logger.update(loss=losses_reduced, **loss_dict_reduced)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+        end = time.perf_counter()
 
     return metric_logger
 
@@ -88,7 +125,7 @@ def evaluate(model, data_loader, device):
     iou_types = _get_iou_types(model)
     coco_evaluator = CocoEvaluator(coco, iou_types)
 
-    for images, targets, metadatas in metric_logger.log_every(data_loader, 100, header):
+    for images, targets, _ in metric_logger.log_every(data_loader, 100, header):
         images = list(img.to(device) for img in images)
 
         if torch.cuda.is_available():
@@ -99,6 +136,11 @@ def evaluate(model, data_loader, device):
         outputs = [{k: v.to(cpu_device) for k, v in t.items()} for t in outputs]
         model_time = time.time() - model_time
 
+        # Boxes of images decoded at a reduced size back to original image coordinates, as the ground truth
+        for target, output in zip(targets, outputs):
+            if "scale" in target:
+                output["boxes"] = output["boxes"] / target["scale"].repeat(2)
+
         res = {target["image_id"].item(): output for target, output in zip(targets, outputs)}
         evaluator_time = time.time()
         coco_evaluator.update(res)
@@ -157,7 +157,7 @@ def _compute_aspect_ratios_subset_dataset(dataset, indices=None):
         indices = range(len(dataset))
 
     ds_indices = [dataset.indices[i] for i in indices]
-    return compute_aspect_ratios(dataset.train_dataset, ds_indices)
+    return compute_aspect_ratios(dataset.dataset, ds_indices)
 
 
 def compute_aspect_ratios(dataset, indices=None):
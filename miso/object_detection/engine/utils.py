@@ -32,7 +32,9 @@ class SmoothedValue:
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device="cuda")
+        # gloo (CPU) can only reduce CPU tensors
+        device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=device)
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -280,3 +282,24 @@ def init_distributed_mode(args):
     )
     torch.distributed.barrier()
     setup_for_distributed(args.rank == 0)
+
+
+def init_distributed(rank, world_size, port, backend=None):
+    """
+    Initialise distributed training in a process started by torch.multiprocessing.spawn on a single machine
+
+    :param rank: rank of this process
+    :param world_size: number of processes
+    :param port: free port on this machine used by the processes to connect
+    :param backend: "nccl" for GPUs or "gloo" for CPUs (default nccl if there is a GPU)
+    """
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    if backend == "nccl":
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    print(f"| distributed init (rank {rank}): {backend}", flush=True)
+    torch.distributed.init_process_group(backend=backend, world_size=world_size, rank=rank)
+    torch.distributed.barrier()
+    setup_for_distributed(rank == 0)
@@ -1,57 +1,145 @@
 import os.path
-from pathlib import Path
+import time
 
 from typing import List
 import copy
-import numpy as np
 import torch
+import torchvision
 import miso.object_detection.engine.utils as utils
 import miso.object_detection.engine.transforms as T
 from miso.object_detection.dataset.annotation import RectangleAnnotation
+from miso.object_detection.dataset.label import Label
+from miso.object_detection.engine.coco_eval import CocoEvaluator
+from miso.object_detection.engine.coco_utils import get_coco_api_from_dataset
 from miso.object_detection.dataset.dataset import ObjectDetectionDataset
-from miso.object_detection.dataset.image import ImageMetadata
 from miso.object_detection.dataset.project import Project
+from miso.object_detection.loader import get_loader_kwargs
+from miso.object_detection.models import compile_backbone, fold_batch_norms, trace_backbone
+from miso.shared.decode import select_fastest_decoders
 
 
-def infer(project: Project,
-          model_path: str,
-          model_labels: List[str] = None,
-          threshold: float = 0.5,
-          batch_size=2,
-          nv: bool = False):
-    if nv:
-        model_labels = [label + "_NV" for label in model_labels]
-    # Ensure labels
-    for label in model_labels:
-        project.add_label(None, label, None)
+# Model optimised for CPU inference by optimize_model
+OPTIMIZED_MODEL_FILENAME = "model_optimized.pt"
 
-    # Load model
-    model = torch.load(model_path)
-    model.cuda()
+
+def load_model(model_path: str, device=None):
+    # Model saved by train or optimize_model, on the GPU if there is one
+    if device is None:
+        device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    # The whole model is pickled, not only the weights
+    model = torch.load(model_path, map_location=device, weights_only=False)
+    model.to(device)
     model.eval()
+    if getattr(model, "jit_backbone", False) and device.type == "cpu":
+        _trace_optimized_backbone(model)
+    return model
 
-    # Create dataset
-    project = copy.deepcopy(project)
-    project.remove_labelled_images()
-    dataset = ObjectDetectionDataset(project, T.Compose([T.ToTensor()]))
 
-    # Get data loader
+def _trace_optimized_backbone(model, tolerance=1e-3):
+    # The TorchScript backbone of an optimised model cannot be pickled, it is traced again with an input of the shape
+    # that optimize_model checked, and only used if it gives the same features as the eager backbone at that shape and
+    # at the second input size that optimize_model checked
+    device = next(model.parameters()).device
+    shapes = [model.jit_example_shape]
+    if getattr(model, "jit_check_shape", None) is not None:
+        shapes.append(model.jit_check_shape)
+    examples = [torch.rand(shape, device=device) for shape in shapes]
+    eager_backbone = model.backbone
+    reference = _backbone_features(model, examples, transform=False)
+    trace_backbone(model, examples[0], model.onednn_fusion)
+    match, error = _features_match(reference, _backbone_features(model, examples, transform=False), tolerance)
+    if not match:
+        print(f"The traced backbone differs from the original (relative error {error:.2e}), using eager mode")
+        model.backbone = eager_backbone
+
+
+def load_model_labels(model_dir: str):
+    # Labels in the order of the model classes, from the labels.txt saved by train
+    labels = []
+    with open(os.path.join(model_dir, "labels.txt")) as fp:
+        for line in fp.readlines():
+            parts = line.split(",")
+            if len(parts) > 1:
+                labels.append(parts[1].strip())
+    return labels
+
+
+def _tile_positions(size, patch_size, step):
+    # Start positions of the tiles along one axis, the last tile ends at the edge of the image
+    if size <= patch_size:
+        return [0]
+    positions = list(range(0, size - patch_size, step))
+    positions.append(size - patch_size)
+    return positions
+
+
+def predict_tiled(model, image, patch_size, batch_size=2, overlap=0.25, iou_threshold=0.5):
+    """
+    Detect objects in an image at native resolution by running the model on overlapping tiles
+
+    Used for models trained on patches (see PatchObjectDetectionDataset). Detections of the same object in
+    overlapping tiles are merged with non-maximum suppression.
+
+    :param model: detection model in eval mode
+    :param image: image tensor (C x H x W) on the model device
+    :param patch_size: tile size, the patch size the model was trained with
+    :param batch_size: number of tiles per forward pass
+    :param overlap: fraction of the tile size that neighbouring tiles overlap
+    :param iou_threshold: IoU above which overlapping detections with the same label are merged
+    :return: dictionary of boxes, labels and scores in image coordinates
+    """
+    height, width = image.shape[1:]
+    step = max(int(patch_size * (1 - overlap)), 1)
+    tiles = [(x, y)
+             for y in _tile_positions(height, patch_size, step)
+             for x in _tile_positions(width, patch_size, step)]
+    boxes, labels, scores = [], [], []
+    for i in range(0, len(tiles), batch_size):
+        batch = tiles[i:i + batch_size]
+        results = model([image[:, y:y + patch_size, x:x + patch_size] for x, y in batch])
+        for (x, y), result in zip(batch, results):
+            boxes.append(result['boxes'] + torch.tensor([x, y, x, y], dtype=torch.float32, device=image.device))
+            labels.append(result['labels'])
+            scores.append(result['scores'])
+    boxes, labels, scores = torch.cat(boxes), torch.cat(labels), torch.cat(scores)
+    keep = torchvision.ops.batched_nms(boxes, scores, labels, iou_threshold)
+    return {'boxes': boxes[keep], 'labels': labels[keep], 'scores': scores[keep]}
+
+
+def _predict(model, images, batch_size):
+    # Detections for a batch of images, tiled for models trained on patches
+    patch_size = getattr(model, "patch_size", None)
+    if patch_size is not None:
+        return [predict_tiled(model, image, patch_size, batch_size) for image in images]
+    return model(images)
+
+
+def _infer_dataset(model, dataset: ObjectDetectionDataset, model_labels, threshold, batch_size, compile_model=False):
+    # Project of the dataset images with the detected boxes
     data_loader = torch.utils.data.DataLoader(dataset,
                                               batch_size=batch_size,
                                               shuffle=False,
-                                              num_workers=4,
+                                              **get_loader_kwargs(),
                                               collate_fn=utils.collate_fn)
+    device = next(model.parameters()).device
 
     # New project
     project = Project()
 
-    idx = 0
     with torch.inference_mode():
-        for images, targets, metadata in data_loader:
-            images_cuda = list(image.cuda() for image in images)
-            results = model(images_cuda)
-            for metadata, result in zip(metadata, results):
-                boxes = result['boxes'][result['scores'] > threshold].cpu().numpy()
+        for i, (images, targets, indices) in enumerate(data_loader):
+            images = list(image.to(device) for image in images)
+            # Compile the backbone, warmed up on the first batch
+            if compile_model and i == 0:
+                compile_backbone(model, images)
+            results = _predict(model, images, batch_size)
+            for image_idx, target, result in zip(indices, targets, results):
+                metadata = dataset.images[image_idx]
+                boxes = result['boxes'][result['scores'] > threshold].cpu()
+                # Map the boxes back to the original image size
+                if 'scale' in target:
+                    boxes = boxes / target['scale'].repeat(2)
+                boxes = boxes.numpy()
                 labels = result['labels'][result['scores'] > threshold].cpu().numpy()
                 for box, label in zip(boxes, labels):
                     ann = RectangleAnnotation(box[0],
@@ -60,72 +148,277 @@ def infer(project: Project,
                                               box[3] - box[1],
                                               model_labels[label - 1])
                     metadata.boxes.append(ann)
-                idx += 1
                 project.add_image(metadata)
     return project
 
 
+def _create_dataset(project: Project, model):
+    # Models trained on patches see the images at native resolution, others at the model input size
+    select_fastest_decoders([image.full_path for image in project.image_dict.values()])
+    if getattr(model, "patch_size", None) is not None:
+        return ObjectDetectionDataset(project, T.Compose([T.ToTensor()]))
+    project.update_image_sizes()
+    return ObjectDetectionDataset(project,
+                                  T.Compose([T.ToTensor()]),
+                                  min_size=max(model.transform.min_size),
+                                  max_size=model.transform.max_size)
+
+
+def infer(project: Project,
+          model_path: str,
+          model_labels: List[str] = None,
+          threshold: float = 0.5,
+          batch_size=2,
+          nv: bool = False,
+          compile_model: bool = False):
+    if nv:
+        model_labels = [label + "_NV" for label in model_labels]
+    # Ensure labels
+    for label in model_labels:
+        project.add_label(None, label, None)
+
+    # Load model
+    model = load_model(model_path)
+
+    # Create dataset
+    project = copy.deepcopy(project)
+    project.remove_labelled_images()
+    dataset = _create_dataset(project, model)
+
+    return _infer_dataset(model, dataset, model_labels, threshold, batch_size, compile_model)
+
+
 def infer_directory(input_dir: str,
                     model_path: str,
                     model_labels: List[str] = None,
                     threshold: float = 0.5,
-                    batch_size=2):
-
-    # Filenames
-    p = Path(input_dir)
-    if not p.exists():
-        raise ValueError(f"Directory does not exist: {input_dir}")
-    paths = p.rglob("*.*")
-    filepaths = []
-    for path in paths:
-        suffix = path.suffix.lower()
-        if suffix == ".jpg" or suffix == ".jpeg" or suffix == ".png" or suffix == ".bmp" or suffix == ".tiff" or suffix == ".tif":
-            filepaths.append(path)
+                    batch_size=2,
+                    compile_model: bool = False):
 
     # Create project
-    project = Project()
-    for i, filepath in enumerate(filepaths):
-        project.add_image(ImageMetadata(filepath, "/", 0, i))
+    project = Project.from_directory(input_dir)
 
     # Ensure labels
     for label in model_labels:
         project.add_label(None, label, None)
 
     # Load model
-    model = torch.load(model_path)
-    model.cuda()
-    model.eval()
+    model = load_model(model_path)
 
     # Create dataset
     project = copy.deepcopy(project)
     project.remove_labelled_images()
-    dataset = ObjectDetectionDataset(project, T.Compose([T.ToTensor()]))
+    dataset = _create_dataset(project, model)
 
-    # Get data loader
-    data_loader = torch.utils.data.DataLoader(dataset,
-                                              batch_size=batch_size,
-                                              shuffle=False,
-                                              num_workers=4,
-                                              collate_fn=utils.collate_fn)
+    return _infer_dataset(model, dataset, model_labels, threshold, batch_size, compile_model)
 
-    # New project
-    project = Project()
 
-    idx = 0
+def compare_models(project: Project, model_dirs: List[str], batch_size=2, max_images=None):
+    """
+    Compare the speed and accuracy of trained models on a reference project
+
+    Each model is evaluated on the images of the project with its labels (COCO AP), and timed on the device it
+    is loaded on. The first batch is not timed as it includes warm up.
+
+    :param project: project with the ground truth boxes
+    :param model_dirs: directories of the models saved by train
+    :param batch_size: batch size
+    :param max_images: only use the first max_images images of the project
+    :return: list of dictionaries of model, arch, parameters, ms per image, AP and AP50
+    """
+    if len(model_dirs) == 0:
+        raise ValueError("No models to compare")
+    # All models are timed on the same device
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    results = []
+    for model_dir in model_dirs:
+        model_labels = load_model_labels(model_dir)
+        model = load_model(os.path.join(model_dir, "model.pt"), device)
+
+        # Ground truth with the model labels, in the order of the model classes
+        model_project = copy.deepcopy(project)
+        model_project.keep_annotations_with_label(model_labels)
+        model_project.remove_unlabelled_images()
+        if max_images is not None:
+            model_project.image_dict = dict(list(model_project.image_dict.items())[:max_images])
+        if len(model_project.image_dict) == 0:
+            raise ValueError(f"No images of the project have the labels of the model in {model_dir}: {model_labels}")
+        model_project.label_dict = {label: model_project.label_dict.get(label, Label(None, label, None))
+                                    for label in model_labels}
+        dataset = _create_dataset(model_project, model)
+        data_loader = torch.utils.data.DataLoader(dataset,
+                                                  batch_size=batch_size,
+                                                  shuffle=False,
+                                                  **get_loader_kwargs(),
+                                                  collate_fn=utils.collate_fn)
+
+        coco_evaluator = CocoEvaluator(get_coco_api_from_dataset(dataset), ["bbox"])
+        model_time, timed_images = 0, 0
+        with torch.inference_mode():
+            for i, (images, targets, _) in enumerate(data_loader):
+                images = list(image.to(device) for image in images)
+                start = time.perf_counter()
+                outputs = _predict(model, images, batch_size)
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                if i > 0 or len(data_loader) == 1:
+                    model_time += time.perf_counter() - start
+                    timed_images += len(images)
+                outputs = [{k: v.cpu() for k, v in output.items()} for output in outputs]
+                for target, output in zip(targets, outputs):
+                    if "scale" in target:
+                        output["boxes"] = output["boxes"] / target["scale"].repeat(2)
+                coco_evaluator.update({target["image_id"].item(): output for target, output in zip(targets, outputs)})
+        coco_evaluator.synchronize_between_processes()
+        coco_evaluator.accumulate()
+        stats = coco_evaluator.summarize()[0]
+
+        results.append({"model": os.path.basename(os.path.normpath(model_dir)),
+                        "arch": getattr(model, "arch", "fasterrcnn_resnet50"),
+                        "parameters": sum(p.numel() for p in model.parameters()),
+                        "ms_per_image": 1000 * model_time / timed_images,
+                        "ap": stats[0],
+                        "ap50": stats[1]})
+
+    print("-" * 80)
+    print(f"Model comparison ({device})")
+    print("-" * 80)
+    print(f"{'model':<24}{'arch':<36}{'params':>8}{'ms/img':>9}{'AP':>7}{'AP50':>7}")
+    for result in results:
+        print(f"{result['model'][:23]:<24}{result['arch']:<36}{result['parameters'] / 1e6:>7.1f}M"
+              f"{result['ms_per_image']:>9.1f}{result['ap']:>7.3f}{result['ap50']:>7.3f}")
+    print("-" * 80)
+    return results
+
+
+def _backbone_features(model, images, transform=True):
+    # Backbone features of each image (or batch if not transform), to check that an optimised model computes the same
     with torch.inference_mode():
-        for images, targets, metadata in data_loader:
-            images_cuda = list(image.cuda() for image in images)
-            results = model(images_cuda)
-            for metadata, result in zip(metadata, results):
-                boxes = result['boxes'][result['scores'] > threshold].cpu().numpy()
-                labels = result['labels'][result['scores'] > threshold].cpu().numpy()
-                for box, label in zip(boxes, labels):
-                    ann = RectangleAnnotation(box[0],
-                                              box[1],
-                                              box[2] - box[0],
-                                              box[3] - box[1],
-                                              model_labels[label - 1])
-                    metadata.boxes.append(ann)
-                idx += 1
-                project.add_image(metadata)
-    return project
+        return [model.backbone(model.transform([image])[0].tensors if transform else image) for image in images]
+
+
+def _features_match(reference, features, tolerance):
+    # Largest difference relative to the largest reference value, for each feature map of each image
+    error = max(((b - a).abs().max() / a.abs().max().clamp(min=1e-12)).item() if a.shape == b.shape else float("inf")
+                for reference_maps, maps in zip(reference, features)
+                for a, b in zip(reference_maps.values(), maps.values()))
+    return error <= tolerance, error
+
+
+def _sample_images(project, num_images):
+    # The first num_images images, with the first image of another size if they all have the same size, so that an
+    # optimised model is checked at two input sizes
+    images = list(project.image_dict.items())[:num_images]
+    sizes = {image.size for _, image in images}
+    if len(sizes) == 1:
+        for key, image in list(project.image_dict.items())[num_images:]:
+            if image.size not in sizes:
+                images.append((key, image))
+                break
+    return dict(images)
+
+
+def _latency(model, images, iterations):
+    # Milliseconds per image, after a warm up pass
+    with torch.inference_mode():
+        _predict(model, images[:1], 1)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for image in images:
+                _predict(model, [image], 1)
+    return 1000 * (time.perf_counter() - start) / (iterations * len(images))
+
+
+def optimize_model(model_dir: str, project: Project, num_images=4, iterations=5, tolerance=1e-3):
+    """
+    Optimise a trained model for inference on CPU
+
+    - the batch norms are folded into the convolutions before them
+    - the weights are converted to channels last, the faster memory layout for the oneDNN convolutions
+    - the backbone is traced and frozen with TorchScript, with and without the oneDNN graph fusion of the
+      convolutions with the operations after them, kept only if its outputs match and it is faster
+
+    The backbone features of the optimised model are checked against the original on sample images, and the
+    latency of each step is printed. The model is saved as model_optimized.pt in the model directory, use it for
+    inference with the --optimized option.
+
+    :param model_dir: directory of the model saved by train
+    :param project: project with sample images (e.g. a few images to infer on)
+    :param num_images: number of sample images, plus one of another size if they all have the same size
+    :param iterations: number of passes over the sample images to time
+    :param tolerance: largest difference of the backbone features, relative to their largest value
+    :return: path of the optimised model
+    """
+    device = torch.device('cpu')
+    model = load_model(os.path.join(model_dir, "model.pt"), device)
+    project = copy.deepcopy(project)
+    project.image_dict = _sample_images(project, num_images)
+    dataset = _create_dataset(project, model)
+    images = [dataset[i][0] for i in range(len(dataset))]
+    if len(images) == 0:
+        raise ValueError("There are no sample images to optimise the model with")
+
+    print("-" * 80)
+    print(f"Optimising {model_dir} for CPU ({len(images)} sample images, {torch.get_num_threads()} threads)")
+    reference = _backbone_features(model, images)
+    latencies = [("original", _latency(model, images, iterations))]
+
+    # Fold the batch norms and convert to channels last
+    optimized = copy.deepcopy(model)
+    num_folded = fold_batch_norms(optimized)
+    optimized.to(memory_format=torch.channels_last)
+    match, error = _features_match(reference, _backbone_features(optimized, images), tolerance)
+    if not match:
+        raise ValueError(f"The outputs of the model with the batch norms folded differ from the original "
+                         f"(relative error {error:.2e})")
+    print(f"- batch norms folded: {num_folded}")
+    print(f"- relative error: {error:.2e}")
+    latencies.append(("folded + channels last", _latency(optimized, images, iterations)))
+
+    # Trace the backbone, with and without oneDNN fusion, the fastest whose outputs match on all the sample images is
+    # kept if it is faster. The example shape, and a second input shape of the sample images, are saved so that
+    # load_model traces the backbone again the same way and checks it at both.
+    optimized.jit_backbone = False
+    optimized.onednn_fusion = False
+    shapes = [tuple(optimized.transform([image])[0].tensors.shape) for image in images]
+    example = optimized.transform(images[:1])[0].tensors
+    optimized.jit_example_shape = shapes[0]
+    optimized.jit_check_shape = next((shape for shape in shapes if shape != shapes[0]), None)
+    if optimized.jit_check_shape is None:
+        print("- the sample images all have the same input size, the traced backbone is only checked at that size")
+    onednn_fusion_enabled = torch.jit.onednn_fusion_enabled()
+    best = latencies[-1][1]
+    for onednn_fusion in (False, True):
+        step = "+ TorchScript / oneDNN" if onednn_fusion else "+ TorchScript"
+        try:
+            traced = copy.deepcopy(optimized)
+            trace_backbone(traced, example, onednn_fusion)
+            match, error = _features_match(reference, _backbone_features(traced, images), tolerance)
+        except Exception as e:
+            print(f"- {step[2:]}: tracing failed ({e})")
+            continue
+        if not match:
+            print(f"- {step[2:]}: outputs differ from the original (relative error {error:.2e}), not used")
+            continue
+        latencies.append((step, _latency(traced, images, iterations)))
+        if latencies[-1][1] < best:
+            best = latencies[-1][1]
+            optimized.jit_backbone = True
+            optimized.onednn_fusion = onednn_fusion
+    # The oneDNN fusion setting is global, it is only turned on again when the model is loaded if it is used
+    torch.jit.enable_onednn_fusion(onednn_fusion_enabled)
+    backbone = "eager"
+    if optimized.jit_backbone:
+        backbone = "TorchScript / oneDNN" if optimized.onednn_fusion else "TorchScript"
+    print(f"- backbone: {backbone}")
+
+    print("-" * 80)
+    print(f"{'model':<28}{'ms/img':>10}{'speed up':>10}")
+    for name, latency in latencies:
+        print(f"{name:<28}{latency:>10.1f}{latencies[0][1] / latency:>9.2f}x")
+    print("-" * 80)
+
+    path = os.path.join(model_dir, OPTIMIZED_MODEL_FILENAME)
+    torch.save(optimized, path)
+    print(f"Saved to {path}")
+    return path
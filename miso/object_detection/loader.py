@@ -0,0 +1,172 @@
+import json
+import os
+import time
+from pathlib import Path
+
+import torch
+import torch.utils.data
+
+import miso.object_detection.engine.utils as utils
+
+
+def available_cores():
+    # Cores this process may run on, which can be fewer than os.cpu_count() in a container
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# Environment variable with the path of the loader config file, default is ~/.config/miso/loader.json
+LOADER_CONFIG_ENV = "MISO_LOADER_CONFIG"
+
+# DataLoader settings used if there is no config file
+DEFAULT_LOADER_CONFIG = {
+    "num_workers": min(4, available_cores()),
+    "prefetch_factor": 2,
+    "pin_memory": False,
+    "persistent_workers": False
+}
+
+
+def loader_config_path():
+    if LOADER_CONFIG_ENV in os.environ:
+        return os.environ[LOADER_CONFIG_ENV]
+    return os.path.join(str(Path.home()), ".config", "miso", "loader.json")
+
+
+def load_loader_config(path=None):
+    """
+    Load the DataLoader settings saved by benchmark_loader, or the defaults if there are none
+
+    :param path: config file (default from loader_config_path)
+    :return: dictionary of num_workers, prefetch_factor, pin_memory and persistent_workers
+    """
+    if path is None:
+        path = loader_config_path()
+    config = dict(DEFAULT_LOADER_CONFIG)
+    if os.path.exists(path):
+        with open(path) as fp:
+            config.update({k: v for k, v in json.load(fp).items() if k in DEFAULT_LOADER_CONFIG})
+    return config
+
+
+def save_loader_config(config, path=None):
+    if path is None:
+        path = loader_config_path()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as fp:
+        json.dump({k: config[k] for k in DEFAULT_LOADER_CONFIG}, fp, indent=4)
+
+
+def get_loader_kwargs(config=None):
+    """
+    DataLoader keyword arguments from a loader config
+
+    Options that only apply to worker processes are left out if there are no workers, and memory is only
+    pinned if there is a GPU.
+
+    :param config: loader config (default is the saved config, see load_loader_config)
+    :return: dictionary of keyword arguments for torch.utils.data.DataLoader
+    """
+    if config is None:
+        config = load_loader_config()
+    kwargs = {
+        "num_workers": config["num_workers"],
+        "pin_memory": config["pin_memory"] and torch.cuda.is_available()
+    }
+    if config["num_workers"] > 0:
+        kwargs["prefetch_factor"] = config["prefetch_factor"]
+        kwargs["persistent_workers"] = config["persistent_workers"]
+    return kwargs
+
+
+def _time_loader(dataset, batch_size, config, num_batches, epochs):
+    # Images per second over a number of epochs of num_batches each, including worker start up
+    sampler = torch.utils.data.RandomSampler(dataset, num_samples=num_batches * batch_size)
+    data_loader = torch.utils.data.DataLoader(dataset,
+                                              batch_size=batch_size,
+                                              sampler=sampler,
+                                              collate_fn=utils.collate_fn,
+                                              **get_loader_kwargs(config))
+    device = torch.device('cuda') if torch.cuda.is_available() else None
+    num_images = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for images, targets, _ in data_loader:
+            if device is not None:
+                images = [image.to(device, non_blocking=True) for image in images]
+            num_images += len(images)
+    if device is not None:
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    del data_loader
+    return num_images / elapsed
+
+
+def benchmark_loader(dataset, batch_size=2, num_batches=50, epochs=2, max_workers=None, verbose=True):
+    """
+    Find the DataLoader settings with the highest throughput for a dataset
+
+    The number of workers is swept first (0, 1, 2, 4, ... up to the number of cores), then the prefetch factor,
+    pinned memory (GPU only) and persistent workers are tried with the best number of workers. Each setting is
+    timed over a number of short epochs so that the cost of starting the workers is included.
+
+    :param dataset: dataset to load, e.g. the ObjectDetectionDataset used for training
+    :param batch_size: batch size
+    :param num_batches: batches per epoch
+    :param epochs: epochs per setting
+    :param max_workers: maximum number of workers (default is the number of cores available)
+    :return: (best config, list of (config, images per second))
+    """
+    if max_workers is None:
+        max_workers = available_cores()
+    worker_counts = [0] + [2 ** i for i in range(max_workers.bit_length()) if 2 ** i <= max_workers]
+    if worker_counts[-1] != max_workers:
+        worker_counts.append(max_workers)
+
+    results = []
+
+    def run(config):
+        images_per_second = _time_loader(dataset, batch_size, config, num_batches, epochs)
+        results.append((dict(config), images_per_second))
+        if verbose:
+            print(f"{config['num_workers']:>8}{config['prefetch_factor']:>10}{str(config['pin_memory']):>8}"
+                  f"{str(config['persistent_workers']):>12}{images_per_second:>12.1f}")
+        return images_per_second
+
+    if verbose:
+        print("-" * 80)
+        print("DataLoader benchmark")
+        print(f"- images: {len(dataset)}")
+        print(f"- batch size: {batch_size}")
+        print(f"- batches per epoch: {num_batches}")
+        print(f"- epochs: {epochs}")
+        print("-" * 80)
+        print(f"{'workers':>8}{'prefetch':>10}{'pin':>8}{'persistent':>12}{'images/s':>12}")
+
+    best = dict(DEFAULT_LOADER_CONFIG)
+    best_rate = 0
+    for num_workers in worker_counts:
+        config = dict(best, num_workers=num_workers)
+        rate = run(config)
+        if rate > best_rate:
+            best, best_rate = config, rate
+
+    options = []
+    if best["num_workers"] > 0:
+        options.append(("prefetch_factor", [4, 8]))
+        options.append(("persistent_workers", [True]))
+    if torch.cuda.is_available():
+        options.append(("pin_memory", [True]))
+    for key, values in options:
+        for value in values:
+            config = dict(best, **{key: value})
+            rate = run(config)
+            if rate > best_rate:
+                best, best_rate = config, rate
+
+    if verbose:
+        print("-" * 80)
+        print(f"Best: {best_rate:.1f} images/s with {best}")
+        print("-" * 80)
+    return best, results
@@ -1,15 +1,118 @@
+import time
+from functools import partial
+
 import torch
+import torch._dynamo
+from torch.nn.utils.fusion import fuse_conv_bn_weights
 from torchvision.models.detection import maskrcnn_resnet50_fpn, MaskRCNN_ResNet50_FPN_Weights
+from torchvision.models.detection._utils import retrieve_out_channels
 from torchvision.models.detection.faster_rcnn import FastRCNNPredictor, fasterrcnn_resnet50_fpn, FasterRCNN_ResNet50_FPN_Weights
+from torchvision.models.detection.faster_rcnn import fasterrcnn_mobilenet_v3_large_fpn, \
+    FasterRCNN_MobileNet_V3_Large_FPN_Weights
+from torchvision.models.detection.fcos import FCOSClassificationHead, fcos_resnet50_fpn, FCOS_ResNet50_FPN_Weights
+from torchvision.models.detection.retinanet import RetinaNetClassificationHead, retinanet_resnet50_fpn, \
+    RetinaNet_ResNet50_FPN_Weights
+from torchvision.models.detection.ssdlite import SSDLiteClassificationHead, ssdlite320_mobilenet_v3_large, \
+    SSDLite320_MobileNet_V3_Large_Weights
+from torchvision.ops.misc import FrozenBatchNorm2d
 from torchvision.models.detection.mask_rcnn import MaskRCNNPredictor
 
 
-def get_object_detection_model(num_classes, model_name="fasterrcnn_resnet50"):
-    if model_name == "fasterrcnn_resnet50":
-        model = fasterrcnn_resnet50_fpn(weights=FasterRCNN_ResNet50_FPN_Weights.DEFAULT, box_detections_per_img=300)
-        in_features = model.roi_heads.box_predictor.cls_score.in_features
-        model.roi_heads.box_predictor = FastRCNNPredictor(in_features, num_classes)
-        return model
+# ResNet backbone layers from the last to the first, trainable_backbone_layers=n trains the last n
+RESNET_LAYERS = ["layer4", "layer3", "layer2", "layer1", "conv1"]
+
+
+def _fasterrcnn_resnet50(num_classes, trainable_backbone_layers):
+    model = fasterrcnn_resnet50_fpn(weights=FasterRCNN_ResNet50_FPN_Weights.DEFAULT,
+                                    box_detections_per_img=300,
+                                    trainable_backbone_layers=trainable_backbone_layers)
+    in_features = model.roi_heads.box_predictor.cls_score.in_features
+    model.roi_heads.box_predictor = FastRCNNPredictor(in_features, num_classes)
+    return model
+
+
+def _fasterrcnn_mobilenet_v3_large_fpn(num_classes, trainable_backbone_layers):
+    model = fasterrcnn_mobilenet_v3_large_fpn(weights=FasterRCNN_MobileNet_V3_Large_FPN_Weights.DEFAULT,
+                                              box_detections_per_img=300,
+                                              trainable_backbone_layers=trainable_backbone_layers)
+    in_features = model.roi_heads.box_predictor.cls_score.in_features
+    model.roi_heads.box_predictor = FastRCNNPredictor(in_features, num_classes)
+    return model
+
+
+def _retinanet_resnet50_fpn(num_classes, trainable_backbone_layers):
+    model = retinanet_resnet50_fpn(weights=RetinaNet_ResNet50_FPN_Weights.DEFAULT,
+                                   detections_per_img=300,
+                                   trainable_backbone_layers=trainable_backbone_layers)
+    num_anchors = model.head.classification_head.num_anchors
+    model.head.classification_head = RetinaNetClassificationHead(model.backbone.out_channels, num_anchors, num_classes)
+    return model
+
+
+def _fcos_resnet50_fpn(num_classes, trainable_backbone_layers):
+    model = fcos_resnet50_fpn(weights=FCOS_ResNet50_FPN_Weights.DEFAULT,
+                              detections_per_img=300,
+                              trainable_backbone_layers=trainable_backbone_layers)
+    num_anchors = model.head.classification_head.num_anchors
+    model.head.classification_head = FCOSClassificationHead(model.backbone.out_channels, num_anchors, num_classes)
+    return model
+
+
+def _ssdlite320_mobilenet_v3_large(num_classes, trainable_backbone_layers):
+    model = ssdlite320_mobilenet_v3_large(weights=SSDLite320_MobileNet_V3_Large_Weights.DEFAULT,
+                                          detections_per_img=300,
+                                          trainable_backbone_layers=trainable_backbone_layers)
+    in_channels = retrieve_out_channels(model.backbone, (320, 320))
+    num_anchors = model.anchor_generator.num_anchors_per_location()
+    model.head.classification_head = SSDLiteClassificationHead(in_channels,
+                                                               num_anchors,
+                                                               num_classes,
+                                                               partial(torch.nn.BatchNorm2d, eps=0.001, momentum=0.03))
+    return model
+
+
+# Detection architectures, all pre-trained on COCO with the classification head replaced for the number of classes
+# The mobilenet models are several times faster on CPU than the ResNet50 models, at a lower accuracy
+MODEL_ARCHITECTURES = {
+    "fasterrcnn_resnet50": _fasterrcnn_resnet50,
+    "fasterrcnn_mobilenet_v3_large_fpn": _fasterrcnn_mobilenet_v3_large_fpn,
+    "retinanet_resnet50_fpn": _retinanet_resnet50_fpn,
+    "fcos_resnet50_fpn": _fcos_resnet50_fpn,
+    "ssdlite320_mobilenet_v3_large": _ssdlite320_mobilenet_v3_large
+}
+
+
+# Architectures with an FPN backbone, the only ones whose trainable backbone layers can be changed after the model is
+# created (see set_trainable_backbone_layers)
+FPN_ARCHITECTURES = [
+    "fasterrcnn_resnet50",
+    "fasterrcnn_mobilenet_v3_large_fpn",
+    "retinanet_resnet50_fpn",
+    "fcos_resnet50_fpn"
+]
+
+
+# Architectures that resize the images to a fixed size, whatever the min_size and max_size of their transform
+FIXED_SIZE_ARCHITECTURES = [
+    "ssdlite320_mobilenet_v3_large"
+]
+
+
+def get_object_detection_model(num_classes, model_name="fasterrcnn_resnet50", trainable_backbone_layers=None):
+    """
+    Detection model of one of the MODEL_ARCHITECTURES
+
+    The architecture is stored in the arch attribute of the model, so that it is saved with it.
+
+    :param num_classes: number of classes including the background
+    :param model_name: architecture name
+    :param trainable_backbone_layers: number of backbone layers to train, from the last (default of the architecture)
+    """
+    if model_name not in MODEL_ARCHITECTURES:
+        raise ValueError(f"Unknown architecture {model_name}, must be one of {', '.join(MODEL_ARCHITECTURES)}")
+    model = MODEL_ARCHITECTURES[model_name](num_classes, trainable_backbone_layers)
+    model.arch = model_name
+    return model
 
 
 def get_instance_segmentation_model(num_classes, model_name="maskrcnn_resnet50"):
@@ -22,4 +125,173 @@ def get_instance_segmentation_model(num_classes, model_name="maskrcnn_resnet50")
         model.roi_heads.mask_predictor = MaskRCNNPredictor(in_features_mask,
                                                            hidden_layer,
                                                            num_classes)
-        return model
\ No newline at end of file
+        return model
+
+
+def set_trainable_backbone_layers(model, trainable_layers):
+    """
+    Freeze the backbone of a detection model except for its last layers
+
+    The FPN and the heads are always trained. With a frozen backbone the activations of the frozen layers are not
+    kept for the backward pass, so training uses less memory and time. The layers are counted as in torchvision:
+    ResNet layers (0 to 5) or MobileNet stages (0 to 6). SSDlite is not supported.
+
+    :param model: detection model with a ResNet or MobileNet FPN backbone (model.backbone.body)
+    :param trainable_layers: number of layers to train, from the last (0 to freeze the backbone)
+    """
+    body = getattr(model.backbone, "body", None)
+    if body is None:
+        raise ValueError(f"Cannot set the trainable backbone layers of {type(model.backbone).__name__}")
+    if hasattr(body, "layer4"):
+        # ResNet
+        if trainable_layers < 0 or trainable_layers > len(RESNET_LAYERS):
+            raise ValueError(f"The number of trainable backbone layers must be between 0 and {len(RESNET_LAYERS)}")
+        layers = RESNET_LAYERS[:trainable_layers]
+        if trainable_layers == len(RESNET_LAYERS):
+            layers.append("bn1")
+        for name, parameter in body.named_parameters():
+            parameter.requires_grad_(any(name.startswith(layer) for layer in layers))
+    else:
+        # MobileNet, the stages start at the blocks that change the resolution
+        blocks = list(body.children())
+        stage_indices = [0] + [i for i, block in enumerate(blocks) if getattr(block, "_is_cn", False)] \
+            + [len(blocks) - 1]
+        if trainable_layers < 0 or trainable_layers > len(stage_indices):
+            raise ValueError(f"The number of trainable backbone layers must be between 0 and {len(stage_indices)}")
+        freeze_before = len(blocks) if trainable_layers == 0 else stage_indices[len(stage_indices) - trainable_layers]
+        for i, block in enumerate(blocks):
+            for parameter in block.parameters():
+                parameter.requires_grad_(i >= freeze_before)
+
+
+def compile_backbone(model, images, train=False, autocast_dtype=None, iterations=3):
+    """
+    Compile the backbone and FPN of a detection model with torch.compile
+
+    The heads are left in eager mode, as their shapes change with the number of proposals and detections. The
+    backbone is compiled with dynamic shapes so that images of different sizes do not each cause a recompilation.
+    Only the forward of the backbone is replaced, so the backbone module and its state dict keys are unchanged and
+    uncompile_backbone goes back to the forward of its class. The compiled backbone is warmed up on the images and
+    its steady state time compared with eager mode. If compilation fails the model is left in eager mode, and later
+    failures (e.g. on new shapes) fall back to eager mode for that call. The model is also left in eager mode if
+    compiling does not make it faster.
+
+    :param model: detection model
+    :param images: list of image tensors on the model device, as given to the model
+    :param train: time the forward and backward passes for training, rather than the forward pass for inference
+    :param autocast_dtype: autocast dtype used for training, if any
+    :param iterations: number of passes timed in each mode
+    :return: True if the backbone was compiled
+    """
+    device = images[0].device
+    was_training = model.training
+    model.train(train)
+    # The warm up should not change the model, e.g. batch norm statistics or gradients
+    state = {k: v.clone() for k, v in model.backbone.state_dict().items()}
+    tensors = model.transform(images)[0].tensors
+
+    def run():
+        if train:
+            with torch.autocast(device_type=device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                features = model.backbone(tensors)
+            sum(feature.float().mean() for feature in features.values()).backward()
+        else:
+            with torch.inference_mode():
+                model.backbone(tensors)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    def timed():
+        start = time.perf_counter()
+        for _ in range(iterations):
+            run()
+        return (time.perf_counter() - start) / iterations
+
+    print("-" * 80)
+    print(f"Compiling the backbone ({'training' if train else 'inference'}, {device})")
+    compiled = True
+    try:
+        run()
+        eager_time = timed()
+        start = time.perf_counter()
+        # Errors are suppressed only in the calls of the compiled forward, not for other compiled code in the process
+        compiled_forward = torch.compile(model.backbone.forward, dynamic=True)
+        model.backbone.forward = torch._dynamo.config.patch(suppress_errors=True)(compiled_forward)
+        run()
+        compile_time = time.perf_counter() - start
+        compiled_time = timed()
+        print(f"- compile time: {compile_time:.1f} s")
+        print(f"- eager: {eager_time * 1000:.1f} ms / batch")
+        print(f"- compiled: {compiled_time * 1000:.1f} ms / batch")
+        print(f"- speed up: {eager_time / compiled_time:.2f}x")
+        if compiled_time >= eager_time:
+            print("Compiling is not faster, using eager mode")
+            uncompile_backbone(model)
+            compiled = False
+    except Exception as e:
+        print(f"Compilation failed, using eager mode: {e}")
+        uncompile_backbone(model)
+        compiled = False
+    model.backbone.load_state_dict(state)
+    model.zero_grad(set_to_none=True)
+    model.train(was_training)
+    print("-" * 80)
+    return compiled
+
+
+def uncompile_backbone(model):
+    # Back to eager mode, e.g. before saving the model, by removing the compiled forward set on the backbone
+    if "forward" in vars(model.backbone):
+        del model.backbone.forward
+
+
+def fold_batch_norms(module):
+    """
+    Fold the batch norms that follow a convolution into the convolution, for inference
+
+    The batch norm layers (FrozenBatchNorm2d in the pre-trained backbones) are replaced by identities and the
+    convolutions scaled and shifted to match. A batch norm is folded into the convolution just before it in its
+    parent module, which is where it is applied in the torchvision backbones. Check the outputs are unchanged.
+
+    :param module: model in eval mode
+    :return: number of batch norms folded
+    """
+    count = 0
+    for child in module.children():
+        count += fold_batch_norms(child)
+    children = list(module.named_children())
+    for (_, conv), (bn_name, bn) in zip(children, children[1:]):
+        if (isinstance(conv, torch.nn.Conv2d) and isinstance(bn, (FrozenBatchNorm2d, torch.nn.BatchNorm2d))
+                and bn.running_mean is not None and conv.out_channels == bn.running_mean.shape[0]):
+            conv.weight, conv.bias = fuse_conv_bn_weights(conv.weight,
+                                                          conv.bias,
+                                                          bn.running_mean,
+                                                          bn.running_var,
+                                                          bn.eps,
+                                                          bn.weight,
+                                                          bn.bias)
+            setattr(module, bn_name, torch.nn.Identity())
+            count += 1
+    return count
+
+
+def trace_backbone(model, example, onednn_fusion=False):
+    """
+    Replace the backbone of a model in eval mode by a frozen TorchScript trace
+
+    With onednn_fusion the convolutions are fused with the operations after them by the oneDNN graph compiler on
+    CPU, which is experimental: check the outputs. This is a global TorchScript setting, it stays on for the rest of
+    the process and also applies to any other TorchScript model. The trace is not saved with the model.
+
+    :param model: detection model in eval mode
+    :param example: example input of the backbone, the operations that depend on its shape are fixed by the trace
+    :param onednn_fusion: enable the oneDNN graph fusion
+    """
+    if onednn_fusion:
+        torch.jit.enable_onednn_fusion(True)
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model.backbone, example, strict=False))
+        # The graph is optimised on the first calls
+        for _ in range(2):
+            traced(example)
+    model.backbone = traced
@@ -0,0 +1,234 @@
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from typing import List
+
+import numpy as np
+import torch
+import torch.multiprocessing
+
+from miso.object_detection.dataset.cache import SharedImageCache
+from miso.object_detection.dataset.project import Project
+from miso.object_detection.loader import available_cores
+from miso.object_detection.training import prepare_project, train
+
+# Columns of the comparison table and their line in results.txt
+SWEEP_RESULTS = {
+    "ap": 0,
+    "ap50": 1,
+    "ap75": 2,
+    "ar100": 8
+}
+
+
+def expand_sweep_spec(spec: dict):
+    """
+    Training arguments of each run of a sweep
+
+    The spec is a dictionary with:
+    - parameters: train arguments to sweep, each a list of values, or for random search a range
+      {"min": ..., "max": ..., "log": true / false} (integers if min and max are both integers)
+    - method: "grid" (default) for every combination of the values, or "random" for num_runs random samples
+    - num_runs: number of runs of a random search
+    - seed: random seed of a random search (default 0)
+    - fixed: train arguments used for every run
+
+    E.g. {"method": "grid", "parameters": {"optimiser": ["sgd", "adam"], "batch_size": [2, 4]}}
+
+    :return: list of dictionaries of train arguments
+    """
+    parameters = spec.get("parameters", {})
+    fixed = spec.get("fixed", {})
+    method = spec.get("method", "grid")
+    if method == "grid":
+        for name, values in parameters.items():
+            if not isinstance(values, list):
+                raise ValueError(f"Grid search values of {name} must be a list")
+        names = list(parameters.keys())
+        return [dict(fixed, **dict(zip(names, values)))
+                for values in itertools.product(*[parameters[name] for name in names])]
+    elif method == "random":
+        rng = np.random.default_rng(spec.get("seed", 0))
+        runs = []
+        for _ in range(spec.get("num_runs", 10)):
+            run = dict(fixed)
+            for name, values in parameters.items():
+                if isinstance(values, list):
+                    run[name] = values[rng.integers(len(values))]
+                elif values.get("log", False):
+                    run[name] = float(np.exp(rng.uniform(np.log(values["min"]), np.log(values["max"]))))
+                else:
+                    run[name] = float(rng.uniform(values["min"], values["max"]))
+                if isinstance(values, dict) and isinstance(values["min"], int) and isinstance(values["max"], int):
+                    run[name] = int(round(run[name]))
+            runs.append(run)
+        return runs
+    raise ValueError("Sweep method must be one of 'grid' or 'random'")
+
+
+def load_sweep_spec(path: str):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def read_results(path: str):
+    # Stats saved by train to results.txt, or None if the run did not finish
+    if not os.path.exists(path):
+        return None
+    with open(path) as fp:
+        stats = [float(line.split("=")[-1]) for line in fp.readlines() if "=" in line]
+    return {name: stats[idx] for name, idx in SWEEP_RESULTS.items()}
+
+
+def _run_arguments(project: Project, run: dict, idx: int, sweep_dir: str, cache: SharedImageCache = None):
+    # Train arguments of a run of a sweep. The cache is keyed by image index only and the runs may decode the images at
+    # different sizes (architectures, min / max size, patches cut from the full image), so with a cache every run
+    # decodes the images at full size.
+    arguments = dict(run)
+    arguments.update(project=project,
+                     labels=None,
+                     output_dir=sweep_dir,
+                     name=f"run_{idx:03d}",
+                     cache=cache,
+                     nproc=1)
+    if cache is not None:
+        arguments["reduced_decode"] = False
+    return arguments
+
+
+def _sweep_process(arguments, cores, memory_fraction, log_path):
+    # Entry point of each training process of a sweep, the output goes to a log file
+    sys.stdout = sys.stderr = open(log_path, "w", buffering=1)
+    if cores is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    if cores is not None:
+        torch.set_num_threads(len(cores))
+    if memory_fraction is not None:
+        torch.cuda.set_per_process_memory_fraction(memory_fraction)
+    train(**arguments)
+
+
+def sweep(project: Project,
+          labels: List[str],
+          runs: List[dict],
+          output_dir: str = None,
+          name: str = None,
+          cores_per_run=2,
+          max_parallel=None,
+          memory_budget_gb=None,
+          cache_gb=0,
+          cache_mode="decoded"):
+    """
+    Train a model for each set of training arguments, several at a time, and compare their results
+
+    Each run is a separate process, pinned to its own cores, that trains with train into output_dir/name/run_NNN
+    and logs to run_NNN.log. The runs share one image cache, so each image is decoded only once for the whole
+    sweep. At the end a table of the arguments and test set AP of each run is printed and saved to results.csv.
+
+    :param project: project to train on
+    :param labels: labels to train on (default all)
+    :param runs: train arguments of each run, e.g. from expand_sweep_spec
+    :param output_dir: directory to save the sweep in
+    :param name: name of the sweep directory (default is the date and time)
+    :param cores_per_run: number of cores of each run, for its threads and DataLoader workers
+    :param max_parallel: maximum number of runs at a time (default is as many as there are cores for)
+    :param memory_budget_gb: GPU memory shared by the runs at a time, each run is limited to its share
+    :param cache_gb: size of the shared image cache in GB
+    :param cache_mode: cache mode, "decoded" or "encoded"
+    :return: list of (run arguments, results dictionary or None if the run failed)
+    """
+    if output_dir is None:
+        output_dir = os.getcwd()
+    if name is None:
+        name = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+    sweep_dir = os.path.join(output_dir, name)
+    os.makedirs(sweep_dir, exist_ok=True)
+
+    # Runs at a time, each with its own cores
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(available_cores()))
+    cores_per_run = max(min(cores_per_run, len(cores)), 1)
+    slots = max(len(cores) // cores_per_run, 1)
+    if max_parallel is not None:
+        slots = min(slots, max_parallel)
+    slots = min(slots, len(runs))
+    memory_fraction = None
+    if memory_budget_gb is not None and torch.cuda.is_available():
+        total = torch.cuda.get_device_properties(0).total_memory
+        memory_fraction = min(memory_budget_gb * 1e9 / slots / total, 1.0)
+
+    print("-" * 80)
+    print("Sweep")
+    print(f"- output directory: {sweep_dir}")
+    print(f"- runs: {len(runs)}")
+    print(f"- runs at a time: {slots}")
+    print(f"- cores per run: {cores_per_run}")
+    if memory_fraction is not None:
+        print(f"- GPU memory per run: {memory_fraction * 100:.0f}%")
+
+    # One cache for all the runs, the images are cached by their index in the prepared project
+    project = prepare_project(project, labels)
+    cache = None
+    if cache_gb > 0:
+        cache = SharedImageCache(len(project.image_dict), cache_gb * 1e9, mode=cache_mode)
+        print(f"- image cache: {cache_gb} GB ({cache_mode}, images decoded at full size)")
+
+    with open(os.path.join(sweep_dir, "sweep.json"), "w") as fp:
+        json.dump(runs, fp, indent=4)
+
+    context = torch.multiprocessing.get_context("spawn")
+    pending = list(enumerate(runs))
+    running = dict()
+    free_slots = list(range(slots))
+    start = time.time()
+    while pending or running:
+        # Start runs in the free slots
+        while pending and free_slots:
+            idx, run = pending.pop(0)
+            slot = free_slots.pop(0)
+            process = context.Process(target=_sweep_process,
+                                      args=(_run_arguments(project, run, idx, sweep_dir, cache),
+                                            cores[slot * cores_per_run:(slot + 1) * cores_per_run],
+                                            memory_fraction,
+                                            os.path.join(sweep_dir, f"run_{idx:03d}.log")))
+            process.start()
+            running[idx] = (process, slot)
+            print(f"[{time.time() - start:8.0f} s] run_{idx:03d} started: {run}")
+        # Wait for a run to finish
+        time.sleep(1)
+        for idx, (process, slot) in list(running.items()):
+            if not process.is_alive():
+                process.join()
+                del running[idx]
+                free_slots.append(slot)
+                status = "finished" if process.exitcode == 0 else f"failed (exit code {process.exitcode})"
+                print(f"[{time.time() - start:8.0f} s] run_{idx:03d} {status}")
+
+    # Comparison table, best AP50 first
+    results = [(run, read_results(os.path.join(sweep_dir, f"run_{idx:03d}", "results.txt")))
+               for idx, run in enumerate(runs)]
+    order = sorted(range(len(runs)), key=lambda i: -1 if results[i][1] is None else results[i][1]["ap50"],
+                   reverse=True)
+    parameters = list(dict.fromkeys(key for run in runs for key in run))
+    with open(os.path.join(sweep_dir, "results.csv"), "w", newline="") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(["run"] + parameters + list(SWEEP_RESULTS))
+        for i in order:
+            run, result = results[i]
+            writer.writerow([f"run_{i:03d}"] + [run.get(key, "") for key in parameters]
+                            + [("" if result is None else f"{result[key]:.3f}") for key in SWEEP_RESULTS])
+    print("-" * 80)
+    print(f"Sweep results ({time.time() - start:.0f} s)")
+    print("-" * 80)
+    print(f"{'run':<10}" + "".join(f"{key[:15]:>16}" for key in parameters)
+          + "".join(f"{key:>8}" for key in SWEEP_RESULTS))
+    for i in order:
+        run, result = results[i]
+        print(f"{f'run_{i:03d}':<10}" + "".join(f"{str(run.get(key, ''))[:15]:>16}" for key in parameters)
+              + "".join(f"{'-' if result is None else f'{result[key]:.3f}':>8}" for key in SWEEP_RESULTS))
+    print("-" * 80)
+    print(f"Saved to {os.path.join(sweep_dir, 'results.csv')}")
+    return results
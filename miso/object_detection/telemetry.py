@@ -0,0 +1,91 @@
+import json
+import os
+import resource
+import time
+
+import torch
+
+TELEMETRY_FILENAME = "telemetry.jsonl"
+
+
+def peak_memory(device: torch.device):
+    # Peak memory in bytes, of the GPU since the last reset, or the largest resident set size of the process on CPU
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Telemetry(object):
+    def __init__(self, path: str, device: torch.device):
+        """
+        Machine readable log of training, one JSON record per line
+
+        Every record has an event ("iteration", "epoch", "evaluation" or "summary") and a time stamp (seconds
+        since the epoch). Iteration records have the time spent waiting for the DataLoader and in the forward
+        pass (including the copy to the device), backward pass and optimizer step, the losses, learning rate and
+        peak memory. The GPU is synchronised before each time stamp so that the times are those of the GPU work,
+        which slows training a little.
+
+        The file is appended to, so a resumed training continues the same log.
+
+        :param path: JSONL file
+        :param device: training device
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.device = device
+        self.fp = open(path, "a")
+        # Totals over the iterations logged
+        self.iterations = 0
+        self.data_time = 0.0
+        self.compute_time = 0.0
+
+    def synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def log(self, event, **fields):
+        self.fp.write(json.dumps(dict(event=event, time=time.time(), **fields)) + "\n")
+
+    def log_iteration(self, epoch, iteration, data_time, forward_time, backward_time, step_time, losses, lr):
+        self.iterations += 1
+        self.data_time += data_time
+        self.compute_time += forward_time + backward_time + step_time
+        self.log("iteration",
+                 epoch=epoch,
+                 iteration=iteration,
+                 data_time=data_time,
+                 forward_time=forward_time,
+                 backward_time=backward_time,
+                 step_time=step_time,
+                 losses={k: float(v) for k, v in losses.items()},
+                 lr=lr,
+                 peak_memory=peak_memory(self.device))
+
+    def data_wait_fraction(self):
+        # Fraction of the training iteration time spent waiting for the DataLoader
+        total = self.data_time + self.compute_time
+        return self.data_time / total if total > 0 else 0.0
+
+    def summary(self):
+        fraction = self.data_wait_fraction()
+        print("Telemetry")
+        print(f"- file: {self.path}")
+        print(f"- iterations: {self.iterations}")
+        print(f"- waiting for data: {self.data_time:.1f} s ({fraction * 100:.1f}%)")
+        print(f"- forward / backward / step: {self.compute_time:.1f} s ({(1 - fraction) * 100:.1f}%)")
+        if fraction > 0.1:
+            print("Training is limited by data loading, see bench-loader, cache-gb and pack-dir")
+        self.log("summary",
+                 iterations=self.iterations,
+                 data_time=self.data_time,
+                 compute_time=self.compute_time,
+                 data_wait_fraction=fraction)
+        self.fp.flush()
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
@@ -1,18 +1,161 @@
 import copy
+import gc
+import math
 import os
+import socket
+import time
 from datetime import datetime
 from typing import List
 
+import numpy as np
 import torch.onnx
 import miso.object_detection.engine.utils as utils
-from miso.object_detection.dataset.dataset import ObjectDetectionDataset
+from miso.object_detection.checkpoint import CHECKPOINT_FILENAME, load_checkpoint, save_checkpoint
+from miso.object_detection.dataset.cache import SharedImageCache
+from miso.object_detection.dataset.dataset import ObjectDetectionDataset, PackedObjectDetectionDataset, \
+    PatchObjectDetectionDataset
+from miso.object_detection.dataset.pack import is_pack_current, pack_project
 from miso.object_detection.dataset.project import Project
+from miso.object_detection.dataset.sampler import RepeatFactorSampler, repeat_factors, stratified_subset
 from miso.object_detection.engine.engine import train_one_epoch, evaluate
-from miso.object_detection.models import get_object_detection_model
+from miso.object_detection.loader import available_cores, get_loader_kwargs
+from miso.object_detection.engine.group_by_aspect_ratio import GroupedBatchSampler, create_aspect_ratio_groups
+from miso.object_detection.models import compile_backbone, get_object_detection_model, \
+    set_trainable_backbone_layers, uncompile_backbone, FPN_ARCHITECTURES, \
+    FIXED_SIZE_ARCHITECTURES
+from miso.object_detection.telemetry import TELEMETRY_FILENAME, Telemetry, peak_memory
 from miso.object_detection.transforms import get_transforms
+from miso.shared.decode import select_fastest_decoders
 from miso.shared.learning_rate_scheduler import AdaptiveLearningRateScheduler
 
 
+SHARING_STRATEGY = "file_system"
+
+# Validation metrics for early stopping and their index in the pycocotools stats
+EARLY_STOPPING_METRICS = {
+    "ap": 0,
+    "ap50": 1,
+    "ap75": 2
+}
+
+
+def _set_worker_sharing_strategy(worker_id: int) -> None:
+    # Module level so that it can be pickled when the workers are spawned
+    torch.multiprocessing.set_sharing_strategy(SHARING_STRATEGY)
+
+
+def prepare_project(project: Project, labels: List[str] = None):
+    # Copy of the project with only the given labels and the images that have them
+    project = copy.deepcopy(project)
+    if labels is not None:
+        project.keep_annotations_with_label(labels)
+    project.remove_unlabelled_images()
+    project.update_label_dict()
+    return project
+
+
+def get_mixed_precision(precision: str, device: torch.device):
+    """
+    Autocast dtype and gradient scaler for a training precision
+
+    - fp32: no autocast
+    - amp: float16 autocast with a gradient scaler on GPU, bfloat16 autocast on CPU (float16 is not supported)
+    - bf16: bfloat16 autocast, no scaler is needed as bfloat16 has the same range as float32
+
+    :return: (autocast dtype or None, GradScaler or None)
+    """
+    if precision == "fp32":
+        return None, None
+    elif precision == "amp":
+        if device.type == "cuda":
+            return torch.float16, torch.cuda.amp.GradScaler()
+        return torch.bfloat16, None
+    elif precision == "bf16":
+        if device.type == "cuda" and not torch.cuda.is_bf16_supported():
+            raise ValueError("This GPU does not support bfloat16, use amp instead")
+        return torch.bfloat16, None
+    else:
+        raise ValueError("Precision must be one of 'fp32', 'amp' or 'bf16'")
+
+
+def _largest_samples(dataset, num_samples):
+    # Indices of the samples with the largest images
+    if isinstance(dataset, torch.utils.data.Subset):
+        sizes = [dataset.dataset.get_height_and_width(idx) for idx in dataset.indices]
+    else:
+        sizes = [dataset.get_height_and_width(idx) for idx in range(len(dataset))]
+    order = sorted(range(len(sizes)), key=lambda idx: sizes[idx][0] * sizes[idx][1], reverse=True)
+    return [order[i % len(order)] for i in range(num_samples)]
+
+
+def find_max_batch_size(model, dataset, device, memory_budget, autocast_dtype=None, max_batch_size=64):
+    """
+    Find the largest batch size for which a training step fits in a GPU memory budget
+
+    Batch sizes 1, 2, 4, ... are tried with the largest images in the dataset, measuring the peak memory of a
+    forward and backward pass. The model is restored afterwards, as the training mode passes update the batch norm
+    running statistics.
+
+    :param model: model on the device
+    :param dataset: training dataset
+    :param device: training device, the probe needs a GPU
+    :param memory_budget: memory budget in bytes
+    :param autocast_dtype: autocast dtype used for training (None for fp32)
+    :param max_batch_size: largest batch size to try
+    :return: largest batch size that fits (at least 1)
+    """
+    if device.type != "cuda":
+        raise ValueError("The batch size probe needs a GPU")
+    # Kept on the CPU, so that the copy does not take GPU memory from the probe
+    state = {k: v.cpu() for k, v in model.state_dict().items()}
+    model.train()
+    best = 1
+    batch_size = 1
+    print(f"Batch size probe (budget {memory_budget / 1e9:.1f} GB)")
+    while batch_size <= max_batch_size:
+        samples = [dataset[idx] for idx in _largest_samples(dataset, batch_size)]
+        images = [image.to(device) for image, _, _ in samples]
+        targets = [{k: v.to(device) for k, v in target.items()} for _, target, _ in samples]
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        try:
+            with torch.autocast(device_type=device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                losses = sum(loss for loss in model(images, targets).values())
+            losses.backward()
+            memory = torch.cuda.max_memory_allocated(device)
+        except torch.cuda.OutOfMemoryError:
+            memory = None
+        model.zero_grad(set_to_none=True)
+        del images, targets, samples
+        if memory is None or memory > memory_budget:
+            print(f"- {batch_size}: {'out of memory' if memory is None else f'{memory / 1e9:.2f} GB'}")
+            break
+        print(f"- {batch_size}: {memory / 1e9:.2f} GB")
+        best = batch_size
+        batch_size *= 2
+    model.load_state_dict(state)
+    torch.cuda.empty_cache()
+    return best
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _train_process(rank, world_size, port, arguments):
+    # Entry point of each process in distributed training
+    utils.init_distributed(rank, world_size, port)
+    # Share the cores between the processes
+    if not torch.cuda.is_available():
+        torch.set_num_threads(max(available_cores() // world_size, 1))
+    try:
+        train(**arguments)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
 def train(project: Project,
           labels: List[str],
           output_dir: str = None,
@@ -22,15 +165,70 @@ def train(project: Project,
           alrs_drops=4,
           alrs_startup_factor=2,
           optimiser='sgd',
-          max_epochs=500):
+          max_epochs=500,
+          cache_gb=0,
+          cache_mode="decoded",
+          pack_dir=None,
+          aspect_ratio_group_factor=3,
+          reduced_decode=True,
+          patch_size=None,
+          sampler="uniform",
+          repeat_threshold=0.1,
+          epoch_length=None,
+          precision="fp32",
+          checkpoint_epochs=1,
+          checkpoint_minutes=None,
+          resume=False,
+          eval_every=1,
+          eval_subset=None,
+          nproc=1,
+          cache: SharedImageCache = None,
+          accumulate_steps=1,
+          memory_budget_gb=None,
+          target_batch_size=None,
+          patience=None,
+          early_stopping_metric="ap50",
+          trainable_backbone_layers=None,
+          freeze_epochs=0,
+          arch="fasterrcnn_resnet50",
+          min_size=None,
+          max_size=None,
+          telemetry=False,
+          compile_model=False,
+          train_only_images: List[str] = None):
+    # Arguments to pass on to the training processes when using distributed training
+    arguments = dict(locals())
+
+    if freeze_epochs > 0 and arch not in FPN_ARCHITECTURES:
+        raise ValueError(f"The backbone of {arch} cannot be frozen for the first epochs, freeze_epochs needs one of "
+                         f"{', '.join(FPN_ARCHITECTURES)}")
+    if (min_size is not None or max_size is not None) and arch in FIXED_SIZE_ARCHITECTURES:
+        raise ValueError(f"{arch} resizes the images to a fixed size, min_size and max_size cannot be changed")
+    if patience is not None and eval_every <= 0:
+        raise ValueError("Early stopping with patience needs the full evaluations of eval_every, it must be above 0")
+
     # Fix project
-    project = copy.deepcopy(project)
-    if labels is not None:
-        project.keep_annotations_with_label(labels)
-    project.remove_unlabelled_images()
-    project.update_label_dict()
+    project = prepare_project(project, labels)
     labels = project.label_names
 
+    # Start a training process for each CPU / GPU, which all run this function with distributed training initialised
+    if nproc > 1 and not utils.is_dist_avail_and_initialized():
+        if name is None:
+            if resume:
+                raise ValueError("The name of the model to resume must be given")
+            arguments["name"] = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        if torch.cuda.is_available() and nproc > torch.cuda.device_count():
+            raise ValueError(f"Only {torch.cuda.device_count()} GPUs are available for {nproc} processes")
+        # The image cache is created here so that all the processes share it
+        if cache is None and cache_gb > 0 and (pack_dir is None or patch_size is not None):
+            arguments["cache"] = SharedImageCache(len(project.image_dict), cache_gb * 1e9, mode=cache_mode)
+        arguments["nproc"] = 1
+        torch.multiprocessing.spawn(_train_process, args=(nproc, _free_port(), arguments), nprocs=nproc)
+        return
+
+    distributed = utils.is_dist_avail_and_initialized()
+    world_size = utils.get_world_size()
+
     print()
     print("=" * 80)
 
@@ -38,6 +236,8 @@ def train(project: Project,
     if output_dir is None:
         output_dir = os.getcwd()
     if name is None:
+        if resume:
+            raise ValueError("The name of the model to resume must be given")
         name = datetime.now().strftime("%Y-%m-%d_%H%M%S")
     output_dir = os.path.join(output_dir, name)
 
@@ -45,55 +245,243 @@ def train(project: Project,
     print(f"- output directory: {output_dir}")
     project.summary()
 
-    # Get datasets
-    dataset_train = ObjectDetectionDataset(project, get_transforms(train=True))
-    dataset_test = ObjectDetectionDataset(project, get_transforms(train=False))
+    torch.multiprocessing.set_sharing_strategy(SHARING_STRATEGY)
+
+    # Device to train on, each process of distributed training has its own GPU
+    if torch.cuda.is_available():
+        device = torch.device('cuda', torch.cuda.current_device())
+    else:
+        device = torch.device('cpu')
+    print(f"Training device is: {device}")
+    if distributed:
+        print(f"Distributed training: {world_size} processes ({torch.distributed.get_backend()})")
+
+    # Get the model and move to correct device
+    num_classes = len(labels) + 1
+    print(f"Number of classes: {num_classes}")
+    print(f"Architecture: {arch}")
+    model = get_object_detection_model(num_classes, arch, trainable_backbone_layers=trainable_backbone_layers)
+    model.to(device)
+    # Trainable backbone parameters of the architecture, to restore them after freeze_epochs
+    backbone_requires_grad = {name: p.requires_grad for name, p in model.backbone.named_parameters()}
+
+    # Input resolution of the model, the images are resized so that their sides are between min_size and max_size
+    if min_size is not None:
+        model.transform.min_size = (min_size,)
+    if max_size is not None:
+        model.transform.max_size = max_size
+    print(f"Model input size: {max(model.transform.min_size)} - {model.transform.max_size}")
 
-    # Split the dataset in train and test set
+    # Image cache shared by the train and test datasets and all their workers
+    if cache is None and cache_gb > 0 and (pack_dir is None or patch_size is not None):
+        cache = SharedImageCache(len(project.image_dict), cache_gb * 1e9, mode=cache_mode)
+        print(f"Image cache: {cache_gb} GB ({cache_mode})")
+
+    # Train on windows of the images at native resolution, the model is set not to resize them
+    if patch_size is not None:
+        model.transform.min_size = (patch_size,)
+        model.transform.max_size = patch_size
+        model.patch_size = patch_size
+        reduced_decode = False
+        print(f"Patch size: {patch_size}")
+
+    # Large JPEGs are decoded at a reduced scale if the model will downsample them anyway
+    decode_min_size, decode_max_size = None, None
+    if reduced_decode:
+        decode_min_size, decode_max_size = max(model.transform.min_size), model.transform.max_size
+    if reduced_decode or aspect_ratio_group_factor >= 0 or patch_size is not None:
+        project.update_image_sizes()
+
+    # Split the images in train and test set, the train_only_images (ids, e.g. with generated boxes) are never tested on
     torch.manual_seed(1)
-    indices = torch.randperm(len(dataset_train)).tolist()
-    fraction = int(0.2 * len(dataset_train))
-    dataset_train = torch.utils.data.Subset(dataset_train, indices[:-fraction])
-    dataset_test = torch.utils.data.Subset(dataset_test, indices[-fraction:])
+    indices = torch.randperm(len(project.image_dict)).tolist()
+    train_only = set() if train_only_images is None else set(train_only_images)
+    image_ids = list(project.image_dict.keys())
+    train_only_indices = [idx for idx in indices if image_ids[idx] in train_only]
+    indices = [idx for idx in indices if image_ids[idx] not in train_only]
+    fraction = int(0.2 * len(indices))
+    train_indices, test_indices = indices[:-fraction] + train_only_indices, indices[-fraction:]
+
+    # Get datasets
+    select_fastest_decoders([image.full_path for image in project.image_dict.values()])
+    if patch_size is not None:
+        dataset_train = PatchObjectDetectionDataset(project,
+                                                    get_transforms(train=True),
+                                                    patch_size,
+                                                    image_indices=train_indices,
+                                                    cache=cache)
+        # Fixed windows centred on each box of the test images
+        dataset_test = PatchObjectDetectionDataset(project,
+                                                   get_transforms(train=False),
+                                                   patch_size,
+                                                   image_indices=test_indices,
+                                                   background_fraction=0,
+                                                   jitter=False,
+                                                   cache=cache)
+    else:
+        if pack_dir is not None:
+            if not is_pack_current(project, pack_dir):
+                pack_project(project, pack_dir)
+            print(f"Packed images: {pack_dir}")
+            dataset_train = PackedObjectDetectionDataset(project, pack_dir, get_transforms(train=True))
+            dataset_test = PackedObjectDetectionDataset(project, pack_dir, get_transforms(train=False))
+        else:
+            dataset_train = ObjectDetectionDataset(project,
+                                                   get_transforms(train=True),
+                                                   cache=cache,
+                                                   min_size=decode_min_size,
+                                                   max_size=decode_max_size)
+            dataset_test = ObjectDetectionDataset(project,
+                                                  get_transforms(train=False),
+                                                  cache=cache,
+                                                  min_size=decode_min_size,
+                                                  max_size=decode_max_size)
+        dataset_train = torch.utils.data.Subset(dataset_train, train_indices)
+        dataset_test = torch.utils.data.Subset(dataset_test, test_indices)
 
     print("Training set images")
-    print(f"- total: {len(indices)}")
-    print(f"- train: {len(dataset_train)}")
-    print(f"- test:  {len(dataset_test)}")
+    print(f"- total: {len(project.image_dict)}")
+    if len(train_only_indices) > 0:
+        print(f"- train only: {len(train_only_indices)}")
+    print(f"- train: {len(train_indices)}")
+    print(f"- test:  {len(test_indices)}")
+    if patch_size is not None:
+        print("Training set patches")
+        print(f"- train: {len(dataset_train)}")
+        print(f"- test:  {len(dataset_test)}")
+
+    # Fixed subset of the test set with every label, evaluated on the epochs without a full evaluation
+    dataset_test_subset = None
+    if eval_subset is not None and eval_subset < len(dataset_test):
+        if patch_size is not None:
+            sample_labels = [[dataset_test.labels[box_idx]] for _, box_idx in dataset_test.windows]
+        else:
+            dataset = dataset_test.dataset
+            sample_labels = [dataset.labels[dataset.box_offsets[idx]:dataset.box_offsets[idx + 1]]
+                             for idx in test_indices]
+        dataset_test_subset = torch.utils.data.Subset(dataset_test, stratified_subset(sample_labels, eval_subset))
+        print(f"- test subset: {len(dataset_test_subset)}")
 
-    sharing_strategy = "file_system"
-    torch.multiprocessing.set_sharing_strategy(sharing_strategy)
+    # Mixed precision
+    autocast_dtype, scaler = get_mixed_precision(precision, device)
+    print(f"Precision: {precision}")
 
-    def set_worker_sharing_strategy(worker_id: int) -> None:
-        torch.multiprocessing.set_sharing_strategy(sharing_strategy)
+    # Largest batch size that fits in the memory budget, and enough accumulation steps to reach the target batch size
+    if memory_budget_gb is not None and device.type != "cuda":
+        print("The memory budget is only used on a GPU")
+    elif memory_budget_gb is not None:
+        batch_size = find_max_batch_size(model, dataset_train, device, memory_budget_gb * 1e9, autocast_dtype)
+        # Each process probes its own GPU, they all use the smallest batch size so that they take the same number of
+        # steps (otherwise the gradient synchronisation hangs)
+        if distributed:
+            batch_size_tensor = torch.tensor(batch_size, device=device)
+            torch.distributed.all_reduce(batch_size_tensor, op=torch.distributed.ReduceOp.MIN)
+            batch_size = int(batch_size_tensor.item())
+    if target_batch_size is not None:
+        accumulate_steps = max(math.ceil(target_batch_size / (batch_size * world_size)), 1)
+    print("Batch size")
+    print(f"- per step: {batch_size}")
+    print(f"- accumulation steps: {accumulate_steps}")
+    print(f"- effective: {batch_size * accumulate_steps * world_size}")
+
+    # Sample images with rare labels more often
+    if sampler == "repeat-factor":
+        image_factors = repeat_factors(project, repeat_threshold, train_indices)
+        if patch_size is not None:
+            sample_images = [image_idx for image_idx, _ in dataset_train.windows]
+        else:
+            sample_images = train_indices
+        train_sampler = RepeatFactorSampler(image_factors[sample_images],
+                                            epoch_length=epoch_length,
+                                            num_replicas=world_size,
+                                            rank=utils.get_rank())
+    elif sampler == "uniform":
+        if not distributed:
+            train_sampler = torch.utils.data.RandomSampler(dataset_train, num_samples=epoch_length)
+        elif epoch_length is None:
+            train_sampler = torch.utils.data.DistributedSampler(dataset_train)
+        else:
+            train_sampler = RepeatFactorSampler(np.ones(len(dataset_train)),
+                                                epoch_length=epoch_length,
+                                                num_replicas=world_size,
+                                                rank=utils.get_rank())
+    else:
+        raise ValueError("Sampler must be one of 'uniform' or 'repeat-factor'")
+    print("Sampler")
+    print(f"- type: {sampler}")
+    if sampler == "repeat-factor":
+        print(f"- repeat threshold: {repeat_threshold}")
+        print(f"- images repeated: {(image_factors[train_indices] > 1).sum()}/{len(train_indices)}")
+    print(f"- samples per epoch: {len(train_sampler)}")
+
+    # Batch images with similar aspect ratios together to reduce padding
+    if aspect_ratio_group_factor >= 0:
+        group_ids = create_aspect_ratio_groups(dataset_train, k=aspect_ratio_group_factor)
+        train_batch_sampler = GroupedBatchSampler(train_sampler,
+                                                  group_ids,
+                                                  batch_size)
+    else:
+        train_batch_sampler = torch.utils.data.BatchSampler(train_sampler,
+                                                            batch_size,
+                                                            drop_last=False)
+
+    # Define training and validation data loaders, with the settings found by bench-loader if it has been run
+    loader_kwargs = get_loader_kwargs()
+    if distributed and loader_kwargs["num_workers"] > 0:
+        loader_kwargs["num_workers"] = max(loader_kwargs["num_workers"] // world_size, 1)
+    # No more workers than the cores this process may run on, e.g. when it is pinned to some cores by sweep
+    if loader_kwargs["num_workers"] > available_cores():
+        loader_kwargs["num_workers"] = available_cores()
+    print(f"Data loader: {loader_kwargs}")
+
+    def test_sampler(dataset):
+        # Each process evaluates part of the test set, the results are gathered by evaluate
+        if distributed:
+            return torch.utils.data.DistributedSampler(dataset, shuffle=False)
+        return torch.utils.data.SequentialSampler(dataset)
 
-    # Define training and validation data loaders
     data_loader_train = torch.utils.data.DataLoader(dataset_train,
-                                                    batch_size=batch_size,
-                                                    shuffle=True,
-                                                    num_workers=4,
+                                                    batch_sampler=train_batch_sampler,
+                                                    **loader_kwargs,
                                                     collate_fn=utils.collate_fn,
-                                                    worker_init_fn=set_worker_sharing_strategy)
+                                                    worker_init_fn=_set_worker_sharing_strategy)
 
     data_loader_test = torch.utils.data.DataLoader(dataset_test,
                                                    batch_size=1,
-                                                   shuffle=False,
-                                                   num_workers=4,
+                                                   sampler=test_sampler(dataset_test),
+                                                   **loader_kwargs,
                                                    collate_fn=utils.collate_fn,
-                                                   worker_init_fn=set_worker_sharing_strategy)
+                                                   worker_init_fn=_set_worker_sharing_strategy)
 
-    # Device to train on
-    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
-    print(f"Training device is: {device}")
+    data_loader_test_subset = None
+    if dataset_test_subset is not None:
+        data_loader_test_subset = torch.utils.data.DataLoader(dataset_test_subset,
+                                                              batch_size=1,
+                                                              sampler=test_sampler(dataset_test_subset),
+                                                              **loader_kwargs,
+                                                              collate_fn=utils.collate_fn,
+                                                              worker_init_fn=_set_worker_sharing_strategy)
 
-    # Get the model and move to correct device
-    num_classes = len(labels) + 1
-    print(f"Number of classes: {num_classes}")
-    model = get_object_detection_model(num_classes)
-    model.to(device)
+    # Compile the backbone, warmed up on the first training images. The random state is restored afterwards so that
+    # the data order and augmentations are the same as without compiling (and when resuming)
+    compiled = False
+    if compile_model:
+        with torch.random.fork_rng(devices=[]):
+            images = [dataset_train[idx][0].to(device) for idx in range(min(batch_size, len(dataset_train)))]
+            compiled = compile_backbone(model, images, train=True, autocast_dtype=autocast_dtype)
 
-    # Construct an optimizer
-    params = [p for p in model.parameters() if p.requires_grad]
+    # Wrap the model for distributed training, the unwrapped model is used for saving
+    model_without_ddp = model
+    if distributed:
+        model = torch.nn.parallel.DistributedDataParallel(model,
+                                                          device_ids=[device] if device.type == "cuda" else None)
+
+    # Construct an optimizer, with all the parameters if the backbone is unfrozen during training (frozen parameters
+    # have no gradient and are not updated)
+    if freeze_epochs > 0:
+        params = list(model.parameters())
+    else:
+        params = [p for p in model.parameters() if p.requires_grad]
     if optimiser == 'sgd':
         opt = torch.optim.SGD(params,
                               lr=0.005,
@@ -110,30 +498,166 @@ def train(project: Project,
                                                  factor=0.5,
                                                  nb_drops=alrs_drops,
                                                  nb_epochs=alrs_epochs,
-                                                 startup_delay_factor=alrs_startup_factor)
+                                                 startup_delay_factor=alrs_startup_factor,
+                                                 patience=patience)
+    # Index of the validation metric in the pycocotools stats
+    metric_index = EARLY_STOPPING_METRICS[early_stopping_metric]
+    # Weights of the model with the best validation metric, if it is used
+    best_model_state = None
     # lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer,
     #                                                step_size=10,
     #                                                gamma=0.5)
 
+    # Continue from the last checkpoint
+    checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILENAME)
+    start_epoch = 0
+    if resume:
+        if os.path.exists(checkpoint_path):
+            start_epoch, best_model_state = load_checkpoint(checkpoint_path,
+                                                            labels,
+                                                            model_without_ddp,
+                                                            opt,
+                                                            lr_scheduler,
+                                                            scaler)
+            print(f"Resuming from {checkpoint_path} at epoch {start_epoch}")
+        else:
+            print(f"No checkpoint found at {checkpoint_path}, starting from the beginning")
+    if utils.is_main_process() and (checkpoint_epochs > 0 or checkpoint_minutes is not None):
+        os.makedirs(output_dir, exist_ok=True)
+    last_checkpoint_time = time.time()
+
+    # Backbone layers trained in each epoch: frozen for the first freeze_epochs, then trainable_backbone_layers
+    # (None for the default of the architecture)
+    def backbone_layers(epoch):
+        return 0 if epoch < freeze_epochs else trainable_backbone_layers
+
+    def backbone_layers_name(layers):
+        return "default" if layers is None else str(layers)
+
+    current_backbone_layers = trainable_backbone_layers
+    # Training time and number of iterations with each number of trainable backbone layers
+    stage_times = dict()
+
+    # Machine readable log of each iteration, one file per process
+    telemetry_log = None
+    if telemetry:
+        telemetry_filename = TELEMETRY_FILENAME
+        if distributed:
+            telemetry_filename = telemetry_filename.replace(".jsonl", f"_{utils.get_rank()}.jsonl")
+        telemetry_log = Telemetry(os.path.join(output_dir, telemetry_filename), device)
+        print(f"Telemetry: {telemetry_log.path}")
+
     # Train
     print("=" * 80)
-    for epoch in range(max_epochs):
+    epoch = start_epoch - 1
+    for epoch in range(start_epoch, max_epochs):
+        if lr_scheduler.finished:
+            break
+        if backbone_layers(epoch) != current_backbone_layers:
+            current_backbone_layers = backbone_layers(epoch)
+            if current_backbone_layers is None:
+                for name, parameter in model_without_ddp.backbone.named_parameters():
+                    parameter.requires_grad_(backbone_requires_grad[name])
+            else:
+                set_trainable_backbone_layers(model_without_ddp, current_backbone_layers)
+            # DDP only synchronises the parameters that needed gradients when it was created, the old wrapper is
+            # deleted first so that its reducer and hooks do not stay attached to the parameters
+            if distributed:
+                del model
+                gc.collect()
+                model = torch.nn.parallel.DistributedDataParallel(
+                    model_without_ddp,
+                    device_ids=[device] if device.type == "cuda" else None)
+            print(f"Trainable backbone layers: {backbone_layers_name(current_backbone_layers)}")
+        if hasattr(train_sampler, "set_epoch"):
+            train_sampler.set_epoch(epoch)
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        epoch_start = time.time()
         # Train for one epoch, printing every 10 iterations
-        metrics = train_one_epoch(model, opt, data_loader_train, device, epoch, print_freq=10)
-        # Evaluate on the test dataset
-        evaluate(model, data_loader_test, device=device)
+        metrics = train_one_epoch(model,
+                                  opt,
+                                  data_loader_train,
+                                  device,
+                                  epoch,
+                                  print_freq=10,
+                                  scaler=scaler,
+                                  autocast_dtype=autocast_dtype,
+                                  accumulate_steps=accumulate_steps,
+                                  telemetry=telemetry_log)
+        epoch_time = time.time() - epoch_start
+        stage_time = stage_times.setdefault(current_backbone_layers, [0.0, 0])
+        stage_time[0] += epoch_time
+        stage_time[1] += len(data_loader_train)
+        print(f"Epoch time: {epoch_time:.1f} s ({epoch_time / len(data_loader_train):.3f} s / it), "
+              f"peak memory: {peak_memory(device) / 1e9:.2f} GB")
+        if telemetry_log is not None:
+            telemetry_log.log("epoch",
+                              epoch=epoch,
+                              epoch_time=epoch_time,
+                              loss=metrics.loss.global_avg,
+                              lr=opt.param_groups[0]["lr"],
+                              peak_memory=peak_memory(device),
+                              trainable_backbone_layers=current_backbone_layers)
+            telemetry_log.flush()
+        # Evaluate on the test dataset every eval_every epochs, and on the test subset (if any) on the other epochs
+        if eval_every > 0 and (epoch + 1) % eval_every == 0:
+            _, stats = evaluate(model, data_loader_test, device=device)
+            if telemetry_log is not None:
+                telemetry_log.log("evaluation",
+                                  epoch=epoch,
+                                  **{name: float(stats[0][idx]) for name, idx in EARLY_STOPPING_METRICS.items()})
+            # Early stopping on the validation metric, keeping the weights of the best epoch
+            if patience is not None and lr_scheduler.step_metric(epoch, stats[0][metric_index]):
+                best_model_state = {k: v.detach().cpu().clone() for k, v in model_without_ddp.state_dict().items()}
+        elif data_loader_test_subset is not None:
+            print(f"Test subset ({len(dataset_test_subset)} of {len(dataset_test)})")
+            evaluate(model, data_loader_test_subset, device=device)
+        if cache is not None:
+            cache.summary()
         # Update the learning rate
-        if lr_scheduler.step(epoch, metrics.loss.global_avg):
+        finished = lr_scheduler.step(epoch, metrics.loss.global_avg)
+        # Save a checkpoint every checkpoint_epochs epochs or checkpoint_minutes minutes
+        if ((checkpoint_epochs > 0 and (epoch + 1) % checkpoint_epochs == 0)
+                or (checkpoint_minutes is not None and time.time() - last_checkpoint_time >= checkpoint_minutes * 60)):
+            if utils.is_main_process():
+                save_checkpoint(checkpoint_path,
+                                epoch,
+                                labels,
+                                model_without_ddp,
+                                opt,
+                                lr_scheduler,
+                                scaler,
+                                best_model_state)
+                print(f"Checkpoint saved: {checkpoint_path}")
+            last_checkpoint_time = time.time()
+        if finished:
             break
 
     print("-" * 80)
     print(f"Training finished, {epoch + 1} epochs")
+    for layers, (total_time, iterations) in stage_times.items():
+        print(f"- trainable backbone layers {backbone_layers_name(layers)}: {total_time / iterations:.3f} s / it "
+              f"({iterations} iterations)")
+    if telemetry_log is not None:
+        telemetry_log.summary()
+        telemetry_log.close()
+    if best_model_state is not None:
+        print(f"Restoring the weights of epoch {lr_scheduler.best_epoch} "
+              f"({early_stopping_metric}: {lr_scheduler.best_metric:.3f})")
+        model_without_ddp.load_state_dict(best_model_state)
     _, stats = evaluate(model, data_loader_test, device=device)
     print("=" * 80)
 
-    # Save the model in torch format
+    # Only the first process saves the results
+    if not utils.is_main_process():
+        return
+
+    # Save the model in torch format, in eager mode
+    if compiled:
+        uncompile_backbone(model_without_ddp)
     os.makedirs(output_dir, exist_ok=True)
-    torch.save(model, os.path.join(output_dir, "model.pt"))
+    torch.save(model_without_ddp, os.path.join(output_dir, "model.pt"))
 
     # Save the labels
     with open(os.path.join(output_dir, "labels.txt"), 'w') as fp:
@@ -0,0 +1,293 @@
+import io
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+try:
+    import torch
+    import torchvision.io
+except ImportError:
+    torchvision = None
+
+# Image format for each file extension
+IMAGE_FORMATS = {
+    ".jpg": "jpeg",
+    ".jpeg": "jpeg",
+    ".png": "png",
+    ".tif": "tiff",
+    ".tiff": "tiff",
+    ".bmp": "bmp"
+}
+
+# PIL modes that can be converted to an array directly, other modes (palette, CMYK, etc.) are converted to RGB first
+_PIL_ARRAY_MODES = ["L", "RGB", "RGBA", "I;16", "I;16B", "I", "F"]
+
+
+def _decode_pil(path, data, draft_size=None):
+    # PIL, or PIL-SIMD / libjpeg-turbo if installed in its place
+    with Image.open(path if data is None else io.BytesIO(data)) as im:
+        if draft_size is not None:
+            # JPEG only: decode at 1/2, 1/4 or 1/8 scale in the DCT domain, keeping the size >= draft_size
+            im.draft(im.mode, draft_size)
+        if im.mode not in _PIL_ARRAY_MODES:
+            im = im.convert("RGB")
+        return np.array(im)
+
+
+def _decode_imagecodecs(path, data):
+    return imagecodecs.imread(path if data is None else data)
+
+
+def _decode_tifffile(path, data):
+    return tifffile.imread(path if data is None else io.BytesIO(data))
+
+
+def _decode_torchvision(path, data):
+    if data is None:
+        encoded = torchvision.io.read_file(str(path))
+    else:
+        encoded = torch.frombuffer(bytearray(data), dtype=torch.uint8)
+    im = torchvision.io.decode_jpeg(encoded)
+    return im.permute(1, 2, 0).squeeze(2).numpy()
+
+
+# Backend name -> (decode function, is available)
+DECODER_BACKENDS = {
+    "pil": (_decode_pil, True),
+    "imagecodecs": (_decode_imagecodecs, imagecodecs is not None),
+    "tifffile": (_decode_tifffile, tifffile is not None),
+    "torchvision": (_decode_torchvision, torchvision is not None)
+}
+
+# Backends that can decode each format, in order of preference until a benchmark has been run
+DECODER_REGISTRY = {
+    "jpeg": ["imagecodecs", "torchvision", "pil"],
+    "png": ["imagecodecs", "pil"],
+    "tiff": ["imagecodecs", "tifffile", "pil"],
+    "bmp": ["imagecodecs", "pil"],
+    "other": ["pil"]
+}
+
+# Backend used for each format, set by select_fastest_decoders or set_decoder
+_selected_decoders = dict()
+
+# Formats already benchmarked by select_fastest_decoders in this process
+_benchmarked_formats = set()
+
+
+def image_format(path):
+    return IMAGE_FORMATS.get(Path(path).suffix.lower(), "other")
+
+
+def available_decoders(fmt):
+    return [name for name in DECODER_REGISTRY.get(fmt, DECODER_REGISTRY["other"]) if DECODER_BACKENDS[name][1]]
+
+
+def set_decoder(fmt, backend):
+    if backend not in available_decoders(fmt):
+        raise ValueError(f"Decoder {backend} is not available for {fmt}, available: {available_decoders(fmt)}")
+    _selected_decoders[fmt] = backend
+
+
+def get_decoder(fmt):
+    if fmt in _selected_decoders:
+        return _selected_decoders[fmt]
+    return available_decoders(fmt)[0]
+
+
+def decode_image(path, data=None, backend=None, draft_size=None):
+    """
+    Decode an image using the selected backend for its format
+
+    :param path: image path, the format is taken from the extension
+    :param data: encoded image bytes, if given these are decoded instead of reading the file
+    :param backend: backend to use (default is the selected backend for the format)
+    :param draft_size: (width, height) the image will be downsampled to. JPEGs are then decoded at a reduced
+    scale with PIL that is at least this size. Ignored for other formats.
+    :return: image array (H x W or H x W x C) in the dtype of the file
+    """
+    fmt = image_format(path)
+    if draft_size is not None and fmt == "jpeg":
+        return _decode_pil(path, data, draft_size)
+    if backend is None:
+        backend = get_decoder(fmt)
+    try:
+        im = DECODER_BACKENDS[backend][0](path, data)
+    except Exception:
+        # Fall back to PIL for files the backend cannot handle (e.g. an unusual TIFF compression)
+        if backend == "pil":
+            raise
+        return _decode_pil(path, data)
+    # Four channels are RGBA or CMYK (JPEG / TIFF), only PIL knows which and converts CMYK to RGB
+    if backend != "pil" and fmt != "png" and im.ndim == 3 and im.shape[2] == 4:
+        return _decode_pil(path, data)
+    return im
+
+
+def _is_cmyk_tiff(path):
+    # CMYK TIFFs are read as raw CMYK by tifffile, they are decoded in full so that they are converted to RGB
+    try:
+        with tifffile.TiffFile(path) as tif:
+            return tif.pages.first.photometric == tifffile.PHOTOMETRIC.SEPARATED
+    except Exception:
+        return False
+
+
+def decode_region(path, region):
+    """
+    Decode a rectangular region of an image
+
+    Only the region is read for formats that allow it:
+    - uncompressed TIFF: memory-mapped with tifffile
+    - tiled or striped compressed TIFF: only the tiles / strips in the region are decoded (requires zarr)
+    - NPY: memory-mapped
+    Other formats are decoded in full and cropped.
+
+    :param path: image path
+    :param region: (x0, y0, x1, y1) in pixels
+    :return: image array of the region in the dtype of the file
+    """
+    x0, y0, x1, y1 = [int(v) for v in region]
+    path = str(path)
+    if path.lower().endswith(".npy"):
+        return np.array(np.load(path, mmap_mode="r")[y0:y1, x0:x1])
+    if image_format(path) == "tiff" and tifffile is not None and not _is_cmyk_tiff(path):
+        try:
+            return np.array(tifffile.memmap(path, mode="r")[y0:y1, x0:x1])
+        except Exception:
+            # Compressed or not contiguous in the file
+            pass
+        if zarr is not None:
+            try:
+                with tifffile.imread(path, aszarr=True) as store:
+                    return np.array(zarr.open(store, mode="r")[y0:y1, x0:x1])
+            except Exception:
+                pass
+    return decode_image(path)[y0:y1, x0:x1]
+
+
+def to_rgb8(im: np.ndarray):
+    """
+    Convert a decoded image to an H x W x 3 uint8 RGB array
+
+    The same as converting the image to RGB with PIL, so that the pixels do not depend on the decoder: values
+    of other dtypes (e.g. 16-bit) are clipped to 0 - 255, not scaled, grayscale is repeated to three channels and
+    alpha is dropped. Four channel images must be RGBA, decode_image converts CMYK to RGB.
+    """
+    if im.dtype == bool:
+        im = im.astype(np.uint8) * 255
+    elif im.dtype != np.uint8:
+        im = np.clip(im, 0, 255).astype(np.uint8)
+    if im.ndim == 2:
+        im = im[..., np.newaxis]
+    if im.shape[2] == 1 or im.shape[2] == 2:
+        im = np.repeat(im[..., :1], 3, axis=2)
+    elif im.shape[2] > 3:
+        im = im[..., :3]
+    return np.ascontiguousarray(im)
+
+
+def benchmark_decoders(paths, repeats=3, tolerance=2):
+    """
+    Time each available decoder on the given images
+
+    The pixels from each backend are compared with PIL, backends that give a different image are not timed.
+
+    :param paths: image paths
+    :param repeats: number of times each image is decoded
+    :param tolerance: largest difference in the RGB pixel values from PIL, JPEG decoders and CMYK conversions
+    may round differently
+    :return: dictionary of format -> backend -> seconds per image (backends that fail or disagree are left out)
+    """
+    paths_by_format = defaultdict(list)
+    for path in paths:
+        paths_by_format[image_format(path)].append(path)
+    results = dict()
+    for fmt, fmt_paths in paths_by_format.items():
+        results[fmt] = dict()
+        references = [to_rgb8(_decode_pil(path, None)).astype(np.int32) for path in fmt_paths]
+        for backend in available_decoders(fmt):
+            decode = DECODER_BACKENDS[backend][0]
+            try:
+                ims = [to_rgb8(decode_image(path, backend=backend)) for path in fmt_paths]
+                if not all(_pixels_match(im, reference, tolerance) for im, reference in zip(ims, references)):
+                    continue
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    for path in fmt_paths:
+                        decode(path, None)
+                elapsed = time.perf_counter() - start
+            except Exception:
+                continue
+            results[fmt][backend] = elapsed / (repeats * len(fmt_paths))
+    return results
+
+
+def _pixels_match(im, reference, tolerance):
+    return im.shape == reference.shape and np.abs(im.astype(np.int32) - reference).max(initial=0) <= tolerance
+
+
+def select_fastest_decoders(paths, max_per_format=3, repeats=3, verbose=True):
+    """
+    Benchmark the decoders on a sample of the images and select the fastest backend for each format
+
+    Each format is benchmarked once per process, later calls keep the backend selected the first time.
+
+    :param paths: image paths to sample from
+    :param max_per_format: number of images of each format to benchmark
+    :param repeats: number of times each image is decoded
+    :return: dictionary of format -> selected backend
+    """
+    sample = defaultdict(list)
+    for path in paths:
+        fmt = image_format(path)
+        if fmt in _benchmarked_formats:
+            continue
+        fmt_paths = sample[fmt]
+        if len(fmt_paths) < max_per_format:
+            fmt_paths.append(path)
+    if len(sample) == 0:
+        return dict(_selected_decoders)
+    results = benchmark_decoders([path for fmt_paths in sample.values() for path in fmt_paths], repeats)
+    _benchmarked_formats.update(results.keys())
+    if verbose:
+        print("Image decoders:")
+    for fmt, timings in results.items():
+        if len(timings) == 0:
+            continue
+        backend = min(timings, key=timings.get)
+        _selected_decoders[fmt] = backend
+        if verbose:
+            timing_str = ", ".join(f"{name}: {t * 1000:.1f} ms" for name, t in timings.items())
+            print(f"- {fmt}: {backend} ({timing_str})")
+    return dict(_selected_decoders)
+
+
+def reduced_size(width, height, min_size, max_size):
+    """
+    Size an image will be resized to by a detection model transform with the given min and max size
+
+    :return: (width, height), or None if the image will not be downsampled
+    """
+    scale = min(min_size / min(width, height), max_size / max(width, height))
+    if scale >= 1:
+        return None
+    return int(width * scale), int(height * scale)
@@ -33,6 +33,14 @@ class RollingBuffer:
     def full(self):
         return self.__counter == self.__buffer_len
 
+    def state_dict(self):
+        return {"buffer": self.__buffer.copy(), "counter": self.__counter, "buffer_len": self.__buffer_len}
+
+    def load_state_dict(self, state_dict):
+        self.__buffer = np.array(state_dict["buffer"])
+        self.__counter = state_dict["counter"]
+        self.__buffer_len = state_dict["buffer_len"]
+
     def slope_probability_less_than(self, prob):
         idxs = np.asarray(self.indices())
         n = len(idxs)
@@ -55,7 +63,19 @@ class AdaptiveLearningRateScheduler(object):
                  nb_drops=4,
                  nb_epochs=10,
                  startup_delay_factor=2,
-                 verbose=True):
+                 verbose=True,
+                 patience=None,
+                 min_delta=0.0):
+        """
+        Reduces the learning rate when the training loss stops decreasing, and finishes training after nb_drops
+        reductions
+
+        Optionally, a validation metric (higher is better, e.g. AP50) can be given with step_metric after each
+        evaluation, and training finishes early when it has not improved for patience evaluations.
+
+        :param patience: number of evaluations without improvement of the validation metric before finishing
+        :param min_delta: minimum increase of the validation metric to count as an improvement
+        """
         super(AdaptiveLearningRateScheduler, self).__init__()
         self.optimizer = optimizer
         self.factor = factor
@@ -67,6 +87,12 @@ class AdaptiveLearningRateScheduler(object):
         self.drop_count = 0
         self.buffer = RollingBuffer(self.nb_epochs)
 
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_metric = None
+        self.best_epoch = None
+        self.evals_without_improvement = 0
+
         self.finished = False
 
     def step(self, epoch, loss):
@@ -78,7 +104,47 @@ class AdaptiveLearningRateScheduler(object):
         if self.verbose:
             print("-" * 80)
         # Finished training?
-        return self.drop_count >= self.nb_drops
+        self.finished = self.finished or self.drop_count >= self.nb_drops
+        return self.finished
+
+    def step_metric(self, epoch, metric):
+        """
+        Update with the validation metric of an evaluation
+
+        :return: True if the metric is the best so far
+        """
+        improved = self.best_metric is None or metric > self.best_metric + self.min_delta
+        if improved:
+            self.best_metric = metric
+            self.best_epoch = epoch
+            self.evals_without_improvement = 0
+        else:
+            self.evals_without_improvement += 1
+        if self.verbose:
+            print(f"Epoch: [{epoch}]  metric: {metric:04f}, best: {self.best_metric:04f} (epoch {self.best_epoch}), "
+                  f"evaluations without improvement: {self.evals_without_improvement}")
+        if self.patience is not None and self.evals_without_improvement >= self.patience:
+            if self.verbose:
+                print(f"No improvement for {self.evals_without_improvement} evaluations, finishing")
+            self.finished = True
+        return improved
+
+    def state_dict(self):
+        # The learning rate itself is saved with the optimizer
+        return {"drop_count": self.drop_count,
+                "finished": self.finished,
+                "buffer": self.buffer.state_dict(),
+                "best_metric": self.best_metric,
+                "best_epoch": self.best_epoch,
+                "evals_without_improvement": self.evals_without_improvement}
+
+    def load_state_dict(self, state_dict):
+        self.drop_count = state_dict["drop_count"]
+        self.finished = state_dict["finished"]
+        self.buffer.load_state_dict(state_dict["buffer"])
+        self.best_metric = state_dict.get("best_metric")
+        self.best_epoch = state_dict.get("best_epoch")
+        self.evals_without_improvement = state_dict.get("evals_without_improvement", 0)
 
     def needs_update_lr(self, epoch, loss):
         self.buffer.append(loss)
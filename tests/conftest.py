@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from miso.object_detection.dataset.annotation import RectangleAnnotation
+from miso.object_detection.dataset.image import ImageMetadata
+from miso.object_detection.dataset.project import Project
+
+
+def make_project(directory, sizes=((64, 48), (48, 64), (80, 60)), labels=("a", "b"), extension=".png"):
+    # Project of random images of the given (width, height) with two boxes each, in directory
+    rng = np.random.default_rng(0)
+    project = Project()
+    for i, (width, height) in enumerate(sizes):
+        path = f"image_{i}{extension}"
+        Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8)).save(directory / path)
+        image = ImageMetadata(path, str(directory), 0, i, width=width, height=height)
+        image.boxes = [RectangleAnnotation(4, 6, 20, 10, labels[0]),
+                       RectangleAnnotation(width - 30, height - 20, 16, 12, labels[i % len(labels)])]
+        project.add_image(image)
+    return project
+
+
+@pytest.fixture
+def project(tmp_path):
+    return make_project(tmp_path)
@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from miso.object_detection.checkpoint import load_checkpoint, save_checkpoint
+from miso.shared.learning_rate_scheduler import AdaptiveLearningRateScheduler
+
+
+def training_state(lr=0.1):
+    model = torch.nn.Linear(3, 2)
+    optimizer = torch.optim.SGD(model.parameters(), lr=lr, momentum=0.9)
+    scheduler = AdaptiveLearningRateScheduler(optimizer, nb_epochs=4, verbose=False, patience=3)
+    scaler = torch.amp.GradScaler("cpu", init_scale=1024.0)
+    return model, optimizer, scheduler, scaler
+
+
+def test_checkpoint_round_trip(tmp_path):
+    model, optimizer, scheduler, scaler = training_state()
+    model(torch.ones(1, 3)).sum().backward()
+    optimizer.step()
+    for epoch, loss in enumerate([1.0, 0.9, 0.8]):
+        scheduler.step(epoch, loss)
+    scheduler.reduce_lr(2)
+    scheduler.drop_count = 1
+    scheduler.step_metric(2, 0.4)
+    scaler.scale(torch.ones(1))
+    scaler.update(512.0)
+    best_model_state = {k: v.clone() for k, v in model.state_dict().items()}
+    path = str(tmp_path / "checkpoint.pt")
+    save_checkpoint(path, 2, ["a", "b"], model, optimizer, scheduler, scaler, best_model_state)
+    assert os.path.exists(path) and not os.path.exists(path + ".tmp")
+    expected_random = torch.rand(3)
+
+    restored = training_state(lr=1.0)
+    torch.rand(5)
+    start_epoch, restored_best = load_checkpoint(path, ["a", "b"], *restored)
+    model2, optimizer2, scheduler2, scaler2 = restored
+
+    assert start_epoch == 3
+    for k, v in model.state_dict().items():
+        assert torch.equal(model2.state_dict()[k], v)
+        assert torch.equal(restored_best[k], best_model_state[k])
+    assert optimizer2.param_groups[0]["lr"] == pytest.approx(0.05)
+    assert torch.equal(optimizer2.state_dict()["state"][0]["momentum_buffer"],
+                       optimizer.state_dict()["state"][0]["momentum_buffer"])
+    assert scheduler2.drop_count == 1
+    np.testing.assert_array_equal(scheduler2.buffer.values(), [1.0, 0.9, 0.8])
+    assert scheduler2.best_metric == 0.4 and scheduler2.best_epoch == 2
+    assert scaler2.get_scale() == 512.0
+    # The random state is that of the end of the saved epoch
+    assert torch.equal(torch.rand(3), expected_random)
+
+
+def test_checkpoint_with_other_labels_is_rejected(tmp_path):
+    path = str(tmp_path / "checkpoint.pt")
+    save_checkpoint(path, 0, ["a"], *training_state())
+    with pytest.raises(ValueError):
+        load_checkpoint(path, ["b"], *training_state())
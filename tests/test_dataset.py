@@ -0,0 +1,20 @@
+import numpy as np
+import torch
+
+from miso.object_detection.dataset.dataset import PackedObjectDetectionDataset
+from miso.object_detection.dataset.pack import pack_project
+from miso.object_detection.engine import transforms as T
+
+
+def test_packed_dataset_flips_do_not_change_the_stored_boxes(project, tmp_path):
+    pack_project(project, str(tmp_path / "pack"))
+    transforms = T.Compose([T.ToTensor(), T.RandomHorizontalFlip(1.0), T.RandomVerticalFlip(1.0)])
+    dataset = PackedObjectDetectionDataset(project, str(tmp_path / "pack"), transforms)
+    boxes = dataset.boxes.copy()
+
+    first = dataset[0][1]["boxes"].clone()
+    np.testing.assert_array_equal(dataset.boxes, boxes)
+    second = dataset[0][1]["boxes"].clone()
+    np.testing.assert_array_equal(dataset.boxes, boxes)
+
+    assert torch.equal(first, second)
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from miso.shared import decode
+from miso.shared.decode import available_decoders, decode_image, decode_region, image_format, to_rgb8
+
+
+def pil_rgb(path):
+    with Image.open(path) as im:
+        return np.array(im.convert("RGB"))
+
+
+def assert_close(im, expected, tolerance=2):
+    # Decoders may round the CMYK conversion (and JPEG decoding) differently
+    assert np.abs(im.astype(np.int32) - expected.astype(np.int32)).max() <= tolerance
+
+
+@pytest.fixture
+def images_16bit(tmp_path):
+    # 12-bit values stored in 16-bit PNG and TIFF
+    im = (np.arange(48 * 64, dtype=np.uint16).reshape(48, 64) % 4096)
+    paths = [tmp_path / "image.png", tmp_path / "image.tif"]
+    for path in paths:
+        Image.fromarray(im).save(path)
+    return paths
+
+
+@pytest.fixture
+def images_cmyk(tmp_path):
+    rng = np.random.default_rng(0)
+    im = Image.fromarray(rng.integers(0, 256, (48, 64, 4), dtype=np.uint8), mode="CMYK")
+    paths = [tmp_path / "image.jpg", tmp_path / "image.tif"]
+    for path in paths:
+        im.save(path)
+    return paths
+
+
+def test_16bit_images_match_pil(images_16bit):
+    for path in images_16bit:
+        for backend in available_decoders(image_format(path)):
+            np.testing.assert_array_equal(to_rgb8(decode_image(path, backend=backend)), pil_rgb(path))
+
+
+def test_cmyk_images_are_converted_to_rgb(images_cmyk):
+    for path in images_cmyk:
+        for backend in available_decoders(image_format(path)):
+            assert_close(to_rgb8(decode_image(path, backend=backend)), pil_rgb(path))
+
+
+def test_cmyk_tiff_region_is_converted_to_rgb(images_cmyk):
+    path = images_cmyk[1]
+    assert_close(to_rgb8(decode_region(path, (8, 4, 40, 30))), pil_rgb(path)[4:30, 8:40])
+
+
+def test_benchmark_leaves_out_decoders_with_other_pixels(images_16bit, monkeypatch):
+    path = images_16bit[0]
+    monkeypatch.setitem(decode.DECODER_BACKENDS, "imagecodecs", (lambda path, data: pil_rgb(path)[::-1], True))
+    assert "imagecodecs" not in decode.benchmark_decoders([path], repeats=1)["png"]
+
+
+def test_decoders_are_benchmarked_once_per_format(images_16bit, monkeypatch):
+    monkeypatch.setattr(decode, "_selected_decoders", dict())
+    monkeypatch.setattr(decode, "_benchmarked_formats", set())
+    benchmarked = []
+
+    def benchmark_decoders(paths, repeats):
+        benchmarked.extend(paths)
+        return {image_format(path): {"pil": 1.0} for path in paths}
+
+    monkeypatch.setattr(decode, "benchmark_decoders", benchmark_decoders)
+    decode.select_fastest_decoders(images_16bit, verbose=False)
+    decode.select_fastest_decoders(images_16bit, verbose=False)
+    assert benchmarked == images_16bit
+    assert decode.get_decoder("png") == "pil"
@@ -0,0 +1,39 @@
+import torch
+
+from miso.object_detection.engine.engine import train_one_epoch
+
+
+class LossModel(torch.nn.Module):
+    # Stands in for a detection model, the loss is the weight times the mean of the images
+    def __init__(self):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.ones(1))
+        self.batches = 0
+
+    def forward(self, images, targets):
+        self.batches += 1
+        return {"loss_images": self.weight * torch.stack([image.mean() for image in images]).sum()}
+
+
+class CountingSGD(torch.optim.SGD):
+    # Records the number of batches seen by the model at each optimizer step
+    def __init__(self, model, lr):
+        super().__init__(model.parameters(), lr=lr)
+        self.model = model
+        self.step_batches = []
+
+    def step(self, closure=None):
+        self.step_batches.append(self.model.batches)
+        return super().step(closure)
+
+
+def test_train_one_epoch_steps_the_optimizer_every_accumulate_steps_batches():
+    model = LossModel()
+    optimizer = CountingSGD(model, lr=0.1)
+    data_loader = [([torch.ones(3, 4, 4)], [{"boxes": torch.zeros(0, 4)}], [0]) for _ in range(8)]
+
+    train_one_epoch(model, optimizer, data_loader, torch.device("cpu"), 0, print_freq=100, accumulate_steps=2)
+
+    assert optimizer.step_batches == [2, 4, 6, 8]
+    # The warmup lasts len(data_loader) // accumulate_steps - 1 = 3 optimizer steps, so it has finished
+    assert optimizer.param_groups[0]["lr"] == 0.1
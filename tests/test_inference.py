@@ -0,0 +1,8 @@
+from miso.object_detection.inference import _sample_images
+from tests.conftest import make_project
+
+
+def test_sample_images_of_one_size_get_an_image_of_another_size(tmp_path):
+    project = make_project(tmp_path, sizes=((64, 48), (64, 48), (64, 48), (48, 64), (80, 60)))
+    assert [image.size for image in _sample_images(project, 2).values()] == [(64, 48), (64, 48), (48, 64)]
+    assert [image.size for image in _sample_images(project, 4).values()] == [(64, 48), (64, 48), (64, 48), (48, 64)]
@@ -0,0 +1,36 @@
+import torch
+
+from miso.shared.learning_rate_scheduler import AdaptiveLearningRateScheduler
+
+
+def test_step_metric_finishes_after_patience_evaluations_and_keeps_the_best_weights():
+    model = torch.nn.Linear(2, 1)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    scheduler = AdaptiveLearningRateScheduler(optimizer, verbose=False, patience=2, min_delta=0.01)
+    best_state = None
+    stop_epoch = None
+    # 0.305 at epoch 2 is not an improvement of more than min_delta on 0.3
+    for epoch, metric in enumerate([0.1, 0.3, 0.305, 0.2, 0.5]):
+        with torch.no_grad():
+            model.weight.fill_(epoch)
+        # As in train: the weights are copied when the metric is the best so far
+        if scheduler.step_metric(epoch, metric):
+            best_state = {k: v.clone() for k, v in model.state_dict().items()}
+        if scheduler.finished:
+            stop_epoch = epoch
+            break
+
+    assert stop_epoch == 3
+    assert scheduler.best_epoch == 1
+    assert scheduler.best_metric == 0.3
+    model.load_state_dict(best_state)
+    assert torch.all(model.weight == 1)
+
+
+def test_step_metric_without_patience_never_finishes():
+    optimizer = torch.optim.SGD(torch.nn.Linear(2, 1).parameters(), lr=0.1)
+    scheduler = AdaptiveLearningRateScheduler(optimizer, verbose=False)
+    for epoch in range(20):
+        scheduler.step_metric(epoch, 0.5)
+    assert not scheduler.finished
+    assert scheduler.evals_without_improvement == 19
@@ -0,0 +1,15 @@
+import numpy as np
+
+from miso.object_detection.dataset.annotation import RectangleAnnotation
+from miso.object_detection.dataset.sampler import repeat_factors
+
+
+def test_repeat_factors_use_the_label_frequencies_of_the_given_images(project):
+    # Label "b" is in image 1 only, add it to image 2 which is left out of the frequencies (e.g. a test image)
+    list(project.image_dict.values())[2].boxes.append(RectangleAnnotation(1, 1, 5, 5, "b"))
+
+    factors = repeat_factors(project, threshold=1.0, indices=[0, 1])
+
+    # "b" is in 1 of the 2 images, "a" in both
+    np.testing.assert_allclose(factors, [1.0, np.sqrt(2), np.sqrt(2)])
+    np.testing.assert_allclose(repeat_factors(project, threshold=1.0), [1.0, np.sqrt(1.5), np.sqrt(1.5)])
@@ -0,0 +1,29 @@
+import numpy as np
+
+from miso.object_detection.dataset.cache import SharedImageCache
+from miso.object_detection.dataset.dataset import ObjectDetectionDataset, PatchObjectDetectionDataset
+from miso.object_detection.sweep import _run_arguments
+from miso.shared.decode import decode_image, to_rgb8
+from tests.conftest import make_project
+
+
+def test_runs_sharing_a_cache_decode_at_full_size(tmp_path):
+    project = make_project(tmp_path, sizes=((640, 480), (480, 640)), extension=".jpg")
+    cache = SharedImageCache(len(project.image_dict), 1e7)
+    runs = [{"arch": "ssdlite320_mobilenet_v3_large"}, {"patch_size": 128, "reduced_decode": True}]
+
+    arguments = [_run_arguments(project, run, idx, str(tmp_path), cache) for idx, run in enumerate(runs)]
+
+    assert [run["reduced_decode"] for run in arguments] == [False, False]
+    assert _run_arguments(project, runs[0], 0, str(tmp_path)).get("reduced_decode", True)
+
+    # The whole image run fills the cache, then the patch run cuts its windows from the cached images
+    images = ObjectDetectionDataset(project, None, cache=cache)
+    for idx in range(len(images)):
+        images._load_image(idx)
+    patches = PatchObjectDetectionDataset(project, None, patch_size=128, background_fraction=0, jitter=False,
+                                          cache=cache)
+    for image_idx, box_idx in patches.windows:
+        x0, y0, x1, y1 = window = patches._window(image_idx, box_idx)
+        expected = to_rgb8(decode_image(images.images[image_idx].full_path))[y0:y1, x0:x1]
+        np.testing.assert_array_equal(patches._load_region(image_idx, window), expected)